@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks for the likelihood and simulation hot paths of loglikelihood_separation.py.
+
+Runs loglikeall, likelihoodSearchRecursive, modelgen3 and their batched counterparts on
+synthetic (epistasis, separation) datasets over a range of sizes, grid scale factors and
+iteration depths. Records wall time, likelihood evaluations per second and peak memory to a
+JSON results file, and compares against a stored baseline run.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from loglikelihood_separation import loglikeall, likelihoodSearchRecursive, modelgen3, modelgen3batch, fitaltbatch, chunkbytes
+
+#---constants---#
+
+#Parameters the synthetic data is drawn from, the binding fit
+a_true = 1.758977
+alpha_true = 0.034037
+
+#Temporaries of chunk size the grid kernels hold at once, and copies of the data they make
+gridtemps = 5
+datacopies = 2
+
+#---functions---#
+
+def synthetic(nrows, seed=0):
+    '''Synthetic epistasis and separation data following the alternative model'''
+    rng = np.random.default_rng(seed)
+    sep = rng.uniform(2.3, 40, nrows)
+    dev = rng.normal(0, a_true*np.exp(-alpha_true*sep))
+    return dev, sep
+
+def gridevals(numiter, scalefactor):
+    '''Likelihood evaluations of a recursive grid search, one per grid cell plus the final one'''
+    return numiter*int(np.ceil(2*scalefactor))**2 + 1
+
+def gridbytes(nrows, scalefactor, nrep=1, batch=False):
+    '''
+    Rough peak memory of a grid search: gridtemps temporaries the size of the whole grid over the
+    data, or of one chunk once that is larger than chunkbytes, plus the copies of the data.
+    The batched kernel only spans the alpha axis of the grid
+    '''
+    cells = int(np.ceil(2*scalefactor))**(1 if batch else 2)
+    return gridtemps*min(8*nrep*nrows*cells, chunkbytes) + datacopies*8*nrep*nrows
+
+def cases(sizes, scales, numiters, nrep):
+    '''
+    All benchmark cases as (name, params, function, evaluations, estimated bytes).
+    Separations and data are made when the case runs
+    '''
+    out = []
+    for n in sizes:
+        out.append(('loglikeall', {'rows' : n}, lambda dev, sep: loglikeall(dev, sep), 1, 8*n))
+        for s in scales:
+            for k in numiters:
+                params = {'rows' : n, 'scale' : s, 'numiter' : k}
+                out.append(('likelihoodSearchRecursive', params,
+                    lambda dev, sep, s=s, k=k: likelihoodSearchRecursive(dev, sep, 1.5, 1, 0.05, 0.05, k, scalefactor=s),
+                    gridevals(k, s), gridbytes(n, s)))
+                out.append(('modelgen3', params,
+                    lambda dev, sep, s=s, k=k: modelgen3(dev, sep, '1.5,1', '0.05,0.05', k, s, rng=np.random.default_rng(0)),
+                    gridevals(k, s) + 1, gridbytes(n, s)))
+                out.append(('modelgen3batch', dict(params, nrep=nrep),
+                    lambda dev, sep, s=s, k=k: modelgen3batch(dev, sep, '1.5,1', '0.05,0.05', k, s, nrep, rng=np.random.default_rng(0)),
+                    None, gridbytes(n, s, nrep, batch=True)))
+        out.append(('fitprofile', {'rows' : n, 'nrep' : nrep},
+            lambda dev, sep: fitaltbatch(np.tile(dev, (nrep, 1)), sep, 1.5, 1, 0.05, 0.05, 0, method='profile'),
+            None, 8*nrep*n))
+    return out
+
+def run(func, dev, sep, repeat):
+    '''
+    Best wall time over repeat runs after one untimed warm-up run (which takes the lazy imports
+    and first-touch allocations), then peak traced memory from one extra run.
+    The edge warnings of the recursive searches are swallowed
+    '''
+    times = []
+    with redirect_stdout(io.StringIO()):
+        func(dev, sep)
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = func(dev, sep)
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        func(dev, sep)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak, result
+
+def evaluations(name, result, evals):
+    '''Likelihood evaluations of a run, taken from the fit results for the batched functions'''
+    if evals is not None:
+        return evals
+    fit = result[1] if name == 'modelgen3batch' else result
+    return int(np.sum(fit['nfev'])) + (len(fit['nfev']) if name == 'modelgen3batch' else 0)
+
+def benchmark(sizes, scales, numiters, nrep=100, repeat=3, memlimit=2.0):
+    '''
+    Runs every case and returns the list of result records. Cases whose estimated peak memory
+    would exceed memlimit GB are recorded as skipped rather than run
+    '''
+    results = []
+    data = {}
+    for name, params, func, evals, nbytes in cases(sizes, scales, numiters, nrep):
+        record = dict(params, name=name)
+        if nbytes > memlimit*2**30:
+            record['skipped'] = 'needs ~{:.1f} GB'.format(nbytes/2**30)
+            results.append(record)
+            print("{:s} {} skipped: {:s}".format(name, params, record['skipped']))
+            continue
+        if params['rows'] not in data:
+            data[params['rows']] = synthetic(params['rows'])
+        dev, sep = data[params['rows']]
+        elapsed, peak, result = run(func, dev, sep, repeat)
+        record['time'] = elapsed
+        record['evals'] = evaluations(name, result, evals)
+        record['evals_per_sec'] = record['evals']/elapsed
+        record['peak_mb'] = peak/2**20
+        results.append(record)
+        print("{:s} {}: {:.4g} s, {:.4g} evals/s, {:.1f} MB".format(name, params, elapsed, record['evals_per_sec'], record['peak_mb']))
+    return results
+
+def casekey(record):
+    '''Identifies a case across runs'''
+    return tuple(sorted((k, v) for k, v in record.items() if k in ('name', 'rows', 'scale', 'numiter', 'nrep')))
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Prints the time ratio of every case against the baseline results and returns the cases
+    that got slower by more than tolerance
+    '''
+    old = {casekey(r) : r for r in baseline if 'time' in r}
+    regressions = []
+    for record in results:
+        key = casekey(record)
+        if 'time' not in record or key not in old:
+            continue
+        ratio = record['time']/old[key]['time']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(record)
+            flag = '  REGRESSION'
+        print("{:s} {}: {:.3f}x baseline time{:s}".format(record['name'], dict(key), ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes',
+            type    =   str,
+            default =   '500,5000,50000,500000,1000000',
+            help    =   "Comma separated dataset sizes (rows)")
+    parser.add_argument('--scales',
+            type    =   str,
+            default =   '4,8',
+            help    =   "Comma separated grid scale factors")
+    parser.add_argument('--numiters',
+            type    =   str,
+            default =   '6,18',
+            help    =   "Comma separated recursion depths")
+    parser.add_argument('--nrep',
+            type    =   int,
+            default =   100,
+            help    =   "Replicates per block for the batched functions")
+    parser.add_argument('--repeat',
+            type    =   int,
+            default =   3,
+            help    =   "Timed runs per case, the best is kept")
+    parser.add_argument('--memlimit',
+            type    =   float,
+            default =   2.0,
+            help    =   "Skip cases whose estimated peak memory would exceed this many GB")
+    parser.add_argument('--out',
+            type    =   str,
+            default =   'benchmark.json',
+            help    =   "Results file")
+    parser.add_argument('--baseline',
+            type    =   str,
+            default =   None,
+            help    =   "Results file of an earlier run to compare against")
+    parser.add_argument('--tolerance',
+            type    =   float,
+            default =   0.2,
+            help    =   "Fractional slowdown against the baseline that counts as a regression")
+    args = parser.parse_args()
+    results = benchmark([int(v) for v in args.sizes.split(',')], [float(v) for v in args.scales.split(',')],
+            [int(v) for v in args.numiters.split(',')], nrep=args.nrep, repeat=args.repeat, memlimit=args.memlimit)
+    meta = {'date' : time.strftime('%Y-%m-%d %H:%M:%S'), 'python' : platform.python_version(),
+            'numpy' : np.__version__, 'machine' : platform.machine(), 'node' : platform.node()}
+    with open(args.out, 'w') as f:
+        json.dump({'meta' : meta, 'results' : results}, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print("{:d} cases slower than baseline by more than {:g}%".format(len(regressions), 100*args.tolerance))
+            sys.exit(1)
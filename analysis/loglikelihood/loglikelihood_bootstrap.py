@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+'''
+Bootstrap confidence intervals for the (a, alpha) parameters of the alternative model
+sigma(epistasis) = a*exp(-alpha*separation), by resampling (epistasis, separation) pairs.
+Resamples are fit in blocks with the batched optimizers of loglikelihood_separation.py,
+with the blocks spread over a process pool and seeded like the simulations there.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import sys
+from functools import partial
+from multiprocessing import Pool
+from scipy.stats import norm
+from loglikelihood_separation import dataload, fitalt, fitaltbatch, optimizers
+
+#---functions---#
+
+def bootstrapblock(devdata,sepdata,ada,alphadalpha,niter,scalefactor,block,method='profile',tol=0.0):
+    '''Fits one (nrep, seed) block of resampled datasets, returns the fitted a, alpha and convergence'''
+    nrep, seed = block
+    rng = np.random.default_rng(seed)
+    ai,da = ada.split(',')
+    alphai,dalpha = alphadalpha.split(',')
+    idx = rng.integers(0, len(devdata), size=(nrep, len(devdata)))
+    fit = fitaltbatch(devdata[idx], sepdata[idx], float(ai), float(da), float(alphai), float(dalpha), niter, scalefactor=scalefactor, method=method, tol=tol)
+    return fit['a'], fit['alpha'], fit['converged']
+
+def bootstrap(devdata,sepdata,ada,alphadalpha,niter,scalefactor,nboot,blocksize,workers=1,seed=None,method='profile',tol=0.0):
+    '''
+    Returns nboot bootstrap estimates of a and alpha and whether each fit converged.
+    Every block has its own stream spawned from seed, so the result doesn't depend on workers
+    '''
+    nreps = [min(blocksize, nboot - i) for i in range(0, nboot, blocksize)]
+    blocks = list(zip(nreps, np.random.SeedSequence(seed).spawn(len(nreps))))
+    job = partial(bootstrapblock, devdata, sepdata, ada, alphadalpha, niter, scalefactor, method=method, tol=tol)
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.map(job, blocks)
+    else:
+        results = [ job(block) for block in blocks ]
+    return [np.concatenate(parts) for parts in zip(*results)]
+
+def jackknifeblock(devdata,sepdata,ada,alphadalpha,niter,scalefactor,block,method='profile',tol=0.0):
+    '''Fits the leave-one-out datasets of rows start to stop, returns the fitted a and alpha'''
+    start, stop = block
+    keep = np.arange(len(devdata) - 1)
+    idx = keep + (keep >= np.arange(start, stop)[:,None])
+    ai,da = ada.split(',')
+    alphai,dalpha = alphadalpha.split(',')
+    fit = fitaltbatch(devdata[idx], sepdata[idx], float(ai), float(da), float(alphai), float(dalpha), niter, scalefactor=scalefactor, method=method, tol=tol)
+    return fit['a'], fit['alpha']
+
+def jackknife(devdata,sepdata,ada,alphadalpha,niter,scalefactor,blocksize=500,workers=1,method='profile',tol=0.0):
+    '''Leave-one-out estimates of a and alpha, fit blocksize at a time so memory stays at blocksize*n'''
+    n = len(devdata)
+    blocks = [(i, min(i + blocksize, n)) for i in range(0, n, blocksize)]
+    job = partial(jackknifeblock, devdata, sepdata, ada, alphadalpha, niter, scalefactor, method=method, tol=tol)
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.map(job, blocks)
+    else:
+        results = [ job(block) for block in blocks ]
+    return [np.concatenate(parts) for parts in zip(*results)]
+
+def percentileinterval(boot, confidence=0.95):
+    '''Percentile bootstrap interval'''
+    tail = (1 - confidence)/2
+    return tuple(np.percentile(boot, [100*tail, 100*(1 - tail)]))
+
+def bcainterval(boot, estimate, jack, confidence=0.95):
+    '''
+    Bias-corrected and accelerated interval (Efron), bias from the share of bootstrap
+    estimates below the full-data estimate and acceleration from the jackknife estimates.
+    The share is clipped to [1/(2B), 1 - 1/(2B)], with a warning, so that a full-data estimate
+    outside every bootstrap estimate gives the most extreme finite correction rather than nan
+    '''
+    tail = (1 - confidence)/2
+    nboot = len(boot)
+    share = (np.sum(boot < estimate) + 0.5*np.sum(boot == estimate))/nboot
+    if not 1/(2*nboot) <= share <= 1 - 1/(2*nboot):
+        print("WARNING: ESTIMATE {:f} OUTSIDE ALL BOOTSTRAP ESTIMATES, BIAS CORRECTION CLIPPED".format(estimate))
+        share = np.clip(share, 1/(2*nboot), 1 - 1/(2*nboot))
+    z0 = norm.ppf(share)
+    dev = jack.mean() - jack
+    spread = np.sum(dev**2)
+    accel = np.sum(dev**3)/(6*spread**1.5) if spread > 0 else 0.0
+    z = norm.ppf([tail, 1 - tail])
+    levels = norm.cdf(z0 + (z0 + z)/(1 - accel*(z0 + z)))
+    return tuple(np.percentile(boot, 100*levels))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datfile',
+            type    =   str,
+            help    =   "The datafile to load. First colunm should be epistasis and second separation distances")
+    parser.add_argument('--nboot',
+            type    =   int,
+            default =   2000,
+            help    =   "The number of bootstrap resamples")
+    parser.add_argument('--out',
+            type    =   str,
+            default =   'bootstrap.txt',
+            help    =   "Output file for the estimates and intervals")
+    parser.add_argument('--samples',
+            type    =   str,
+            default =   None,
+            help    =   "If given, writes the bootstrap estimates of a and alpha the intervals used here")
+    parser.add_argument('--interval',
+            type    =   str,
+            default =   'bca',
+            choices =   ['bca', 'percentile'],
+            help    =   "Interval type, BCa or percentile")
+    parser.add_argument('--confidence',
+            type    =   float,
+            default =   0.95,
+            help    =   "Confidence level of the intervals")
+    parser.add_argument('--alphadalpha',
+            type    =   str,
+            default =   '1,0.5',
+            help    =   "Initial estimate for alpha and delta")
+    parser.add_argument('--ada',
+            type    =   str,
+            default =   '1,3',
+            help    =   "Initial guess for a and delta")
+    parser.add_argument('--numiter',
+            type    =   int,
+            default =   18,
+            help    =   "Number of recursive iterations, grid method only")
+    parser.add_argument('--scale',
+            type    =   float,
+            default =   8,
+            help    =   "The fraction and number of estimates, grid method only")
+    parser.add_argument('--method',
+            type    =   str,
+            default =   'profile',
+            choices =   sorted(optimizers),
+            help    =   "Optimizer for the fits, see loglikelihood_separation.py")
+    parser.add_argument('--tol',
+            type    =   float,
+            default =   0.0,
+            help    =   "Stop a fit once an iteration can improve the log-likelihood by no more than this")
+    parser.add_argument('--blocksize',
+            type    =   int,
+            default =   500,
+            help    =   "Number of resamples (and of jackknife fits) fit together")
+    parser.add_argument('--workers',
+            type    =   int,
+            default =   1,
+            help    =   "Number of processes to spread the blocks over")
+    parser.add_argument('--seed',
+            type    =   int,
+            default =   None,
+            help    =   "Seed for the resampling, a fresh one is drawn and printed if not given")
+    parser.add_argument('--keepunconverged',
+            action  =   'store_true',
+            help    =   "Keep unconverged bootstrap fits in the intervals, by default they are dropped")
+    parser.add_argument('--outlier',
+            action  =   'store_true',
+            help    =   "If outlier exists, will delete from dataset")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    if args.blocksize < 1:
+        parser.error("--blocksize must be at least 1")
+    dev,sep = dataload(args.datfile, outlier=args.outlier)
+    ai, da = args.ada.split(',')
+    alphai,dalpha = args.alphadalpha.split(',')
+    fit = fitalt(dev, sep, float(ai), float(da), float(alphai), float(dalpha), args.numiter, scalefactor=args.scale, method=args.method, tol=args.tol)
+    seed = np.random.SeedSequence(args.seed).entropy
+    print("Seed: {:d}".format(seed))
+    boot_a, boot_alpha, converged = bootstrap(dev, sep, args.ada, args.alphadalpha, args.numiter, args.scale, args.nboot, args.blocksize,
+            workers=args.workers, seed=seed, method=args.method, tol=args.tol)
+    print("Unconverged fits: {:d} of {:d}, {:s}".format(int(np.sum(~converged)), args.nboot,
+            "kept in the intervals" if args.keepunconverged else "dropped from the intervals"))
+    if not args.keepunconverged:
+        boot_a, boot_alpha = boot_a[converged], boot_alpha[converged]
+    if len(boot_a) == 0:
+        sys.exit("No converged bootstrap fits to build intervals from")
+    if args.interval == 'bca':
+        jack_a, jack_alpha = jackknife(dev, sep, args.ada, args.alphadalpha, args.numiter, args.scale,
+                blocksize=args.blocksize, workers=args.workers, method=args.method, tol=args.tol)
+        intervals = [bcainterval(boot_a, fit['a'], jack_a, args.confidence), bcainterval(boot_alpha, fit['alpha'], jack_alpha, args.confidence)]
+    else:
+        intervals = [percentileinterval(boot_a, args.confidence), percentileinterval(boot_alpha, args.confidence)]
+    with open(args.out, 'w') as f:
+        f.write("parameter\testimate\tlower\tupper\n")
+        for name, interval in zip(['a', 'alpha'], intervals):
+            f.write("{:s}\t{:f}\t{:f}\t{:f}\n".format(name, fit[name], *interval))
+            print("{:s}: {:f} ({:g}% {:s} interval {:f} to {:f})".format(name, fit[name], 100*args.confidence, args.interval, *interval))
+    if args.samples is not None:
+        np.savetxt(args.samples, np.column_stack([boot_a, boot_alpha]), fmt='%f', delimiter='\t', header='a\talpha', comments='')
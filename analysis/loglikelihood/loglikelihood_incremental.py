@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+'''
+Incremental version of the experimental likelihood ratio fit. Keeps a state file per dataset
+so rows appended to the datafile only cost their own parsing and a warm-started refit.
+
+The alternative model needs S(alpha) = sum((x-mean)^2 * exp(2*alpha*r)), which has no finite
+sufficient statistics in alpha. The state instead keeps the moments
+T[j,k] = sum(u^j * r^k * exp(2*alpha0*r)), u = x - c, around an anchor alpha0, so that
+S(alpha0 + delta) and its derivatives are exact Taylor series in delta. While the optimum stays
+within the radius of the series the original rows are never read again; if it moves further the
+state is re-anchored with one full rescan. The datafile is taken to only grow by appending: the
+state records a hash of the bytes it has consumed, and any change to them means a full rebuild.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import hashlib
+import json
+import os
+import sys
+from math import factorial
+from loglikelihood_separation import norm_logC, fitalt
+
+#---constants---#
+
+#Number of moments kept per power of u, and the largest 2*|delta|*max(r) the series is trusted for.
+#The truncation error is then below radius^(order+1)/(order+1)! relative
+order = 24
+radius = 2.0
+
+#Block size for hashing the consumed part of the datafile
+hashblock = 2**20
+
+#---functions---#
+
+def readrows(datafile, offset=0, columns=None):
+    '''
+    Reads the complete lines of a tab/space separated datafile from byte offset on.
+    columns are the indices of epistasis and separation, taken from the header when None
+    ('epistasis' and 'separation' if present, otherwise the first two columns, as in dataload).
+    Returns epistasis, separation, the offset after the last complete line and the columns
+    '''
+    with open(datafile, 'rb') as f:
+        if columns is None:
+            header = f.readline().decode().split()
+            if 'epistasis' in header and 'separation' in header:
+                columns = [header.index('epistasis'), header.index('separation')]
+            else:
+                columns = [0, 1]
+            offset = f.tell()
+        f.seek(offset)
+        chunk = f.read()
+    end = chunk.rfind(b'\n') + 1
+    lines = [line.split() for line in chunk[:end].decode().splitlines() if line.strip()]
+    rows = np.array([[float(line[columns[0]]), float(line[columns[1]])] for line in lines]).reshape(-1, 2)
+    return rows[:,0], rows[:,1], offset + end, columns
+
+def prefixhash(datafile, offset, start=0, h=None):
+    '''
+    sha256 of the bytes of datafile from start up to offset, continuing h if given (start is then
+    where h left off). Returns the hash object, or None if the file is shorter than offset
+    '''
+    h = hashlib.sha256() if h is None else h
+    with open(datafile, 'rb') as f:
+        f.seek(start)
+        while start < offset:
+            block = f.read(min(hashblock, offset - start))
+            if not block:
+                return None
+            h.update(block)
+            start += len(block)
+    return h
+
+def momentsupdate(state, x, rset):
+    '''Adds rows to the moments and null statistics of state, in place'''
+    if len(x) == 0:
+        return state
+    u = x - state['c']
+    w = np.exp(2*state['alpha0']*rset)
+    rpow = rset[None,:]**np.arange(order + 1)[:,None]
+    T = np.array(state['T'])
+    for j in range(3):
+        T[j] += rpow @ (u**j * w)
+    state['T'] = T.tolist()
+    #Chan et al. pairwise update of the mean and sum of squares for the null model
+    n_new = len(x)
+    mean_new = np.mean(x)
+    m2_new = np.sum((x - mean_new)**2)
+    n = state['n'] + n_new
+    delta = mean_new - state['mean']
+    state['m2'] += m2_new + delta**2 * state['n']*n_new/n
+    state['mean'] += delta*n_new/n
+    state['n'] = n
+    state['rsum'] += float(np.sum(rset))
+    state['rmax'] = max(state['rmax'], float(np.max(rset)))
+    return state
+
+def profileseries(state, alpha):
+    '''
+    Profile log-likelihood of alpha and its first two derivatives from the moments in state,
+    the same quantities fitprofile computes from the rows
+    '''
+    T = np.array(state['T'])
+    n = state['n']
+    twodelta = 2*(alpha - state['alpha0'])
+    coef = np.array([twodelta**k/factorial(k) for k in range(order + 1)])
+    #sums of u^j*exp(2*alpha*r) and its first two derivatives, shifting k by the derivative order
+    E = np.array([[2**m * np.dot(T[j, m:], coef[:order + 1 - m]) for m in range(3)] for j in range(3)])
+    d = state['mean'] - state['c']
+    S, S1, S2 = E[2] - 2*d*E[1] + d**2*E[0]
+    pl = -n/2*(1 + np.log(S/n)) + alpha*state['rsum'] - n*norm_logC
+    grad = -n/2*S1/S + state['rsum']
+    hess = -n/2*(S2*S - S1**2)/S**2
+    return pl, grad, hess, S
+
+def fitseries(state, tol=0.0, maxiter=100):
+    '''
+    Newton search on the series profile likelihood warm-started from the stored alpha.
+    Returns the fit and whether it stayed inside the radius the series is trusted for
+    '''
+    alpha = state['alpha']
+    loglike, grad, hess, S = profileseries(state, alpha)
+    converged = False
+    for it in range(maxiter):
+        step = -grad/hess if hess < 0 else np.sign(grad)
+        for halving in range(60):
+            pl, g, h, s = profileseries(state, alpha + step)
+            if pl >= loglike:
+                break
+            step /= 2
+        else:
+            converged = True
+            break
+        gain = pl - loglike
+        alpha, loglike, grad, hess, S = alpha + step, pl, g, h, s
+        if gain <= tol:
+            converged = True
+            break
+    inside = 2*abs(alpha - state['alpha0'])*state['rmax'] <= radius
+    return {'loglike' : loglike, 'a' : np.sqrt(S/state['n']), 'alpha' : alpha, 'converged' : converged}, inside
+
+def rebuild(datafile, alpha0=None, ada='1,3', alphadalpha='1,0.5', tol=0.0):
+    '''
+    Builds the state from the whole datafile. The anchor is alpha0 if given, otherwise a profile
+    fit of the rows from the ada/alphadalpha starting point
+    '''
+    x, rset, offset, columns = readrows(datafile)
+    if alpha0 is None:
+        ai, da = ada.split(',')
+        alphai, dalpha = alphadalpha.split(',')
+        alpha0 = fitalt(x, rset, float(ai), float(da), float(alphai), float(dalpha), 0, method='profile', tol=tol)['alpha']
+    state = {'datfile' : os.path.abspath(datafile), 'columns' : columns, 'offset' : 0,
+             'alpha0' : float(alpha0), 'alpha' : float(alpha0), 'c' : float(np.mean(x)),
+             'T' : np.zeros((3, order + 1)).tolist(), 'n' : 0, 'mean' : 0.0, 'm2' : 0.0, 'rsum' : 0.0, 'rmax' : 0.0}
+    momentsupdate(state, x, rset)
+    state['offset'] = offset
+    state['prefix'] = prefixhash(datafile, offset).hexdigest()
+    return state
+
+def refit(datafile, statefile, ada='1,3', alphadalpha='1,0.5', tol=0.0):
+    '''
+    Brings the state for datafile up to date and refits. Only rows appended since the last call
+    are read; the state is rebuilt from scratch if it is missing, belongs to another file or the
+    rows it already consumed are no longer the same bytes, and re-anchored at the new optimum while it lies outside the series radius.
+    Returns the state and the fit (with the null log-likelihood and lambda added)
+    '''
+    state = None
+    h = None
+    if os.path.exists(statefile):
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+        if state['datfile'] == os.path.abspath(datafile) and os.path.getsize(datafile) >= state['offset']:
+            h = prefixhash(datafile, state['offset'])
+        if h is None or h.hexdigest() != state.get('prefix'):
+            state = None
+    if state is None:
+        state = rebuild(datafile, ada=ada, alphadalpha=alphadalpha, tol=tol)
+    else:
+        x, rset, offset, columns = readrows(datafile, state['offset'], state['columns'])
+        momentsupdate(state, x, rset)
+        state['prefix'] = prefixhash(datafile, offset, state['offset'], h).hexdigest()
+        state['offset'] = offset
+    fit, inside = fitseries(state, tol=tol)
+    for anchor in range(10):
+        if inside:
+            break
+        state = rebuild(datafile, alpha0=fit['alpha'], tol=tol)
+        fit, inside = fitseries(state, tol=tol)
+    state['alpha'] = float(fit['alpha'])
+    state['a'] = float(fit['a'])
+    fit['null'] = -state['n']/2*(1 + np.log(2*np.pi*state['m2']/state['n']))
+    fit['lambda'] = fit['null'] - fit['loglike']
+    with open(statefile + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(statefile + '.tmp', statefile)
+    return state, fit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datfile',
+            type    =   str,
+            help    =   "The datafile to load. Uses the epistasis and separation columns if named, otherwise the first two")
+    parser.add_argument('--state',
+            type    =   str,
+            default =   None,
+            help    =   "State file kept between runs, defaults to <datfile>.state.json")
+    parser.add_argument('--alphadalpha',
+            type    =   str,
+            default =   '1,0.5',
+            help    =   "Initial estimate for alpha and delta, only used when the state is built")
+    parser.add_argument('--ada',
+            type    =   str,
+            default =   '1,3',
+            help    =   "Initial guess for a and delta, only used when the state is built")
+    parser.add_argument('--tol',
+            type    =   float,
+            default =   0.0,
+            help    =   "Stop the fit once a step improves the log-likelihood by no more than this")
+    parser.add_argument('--expout',
+            type    =   str,
+            default =   None,
+            help    =   "If given, writes the experimental lambda here")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    statefile = args.state if args.state is not None else args.datfile + '.state.json'
+    state, fit = refit(args.datfile, statefile, ada=args.ada, alphadalpha=args.alphadalpha, tol=args.tol)
+    print("Rows: {:d}".format(state['n']))
+    print("Fit: a = {:f}, alpha = {:f}, converged: {}".format(fit['a'], fit['alpha'], fit['converged']))
+    print("Exp: {:f}".format(fit['lambda']))
+    if args.expout is not None:
+        with open(args.expout, 'w') as f:
+            f.write("{:f}".format(fit['lambda']))
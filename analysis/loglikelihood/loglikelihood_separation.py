@@ -3,18 +3,90 @@
 #---imports---#
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import norm
 import argparse
+import json
+import os
 import sys
+import time
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing'))
+from tablecache import loadcolumns
+
+#scipy is imported in the few functions that use it (the reference kernels, the L-BFGS backend and
+#the p-value interval), so starting the script and loading the data only costs numpy
+
+#---constants---#
+
+#Same normalisation constant scipy uses in norm.logpdf
+norm_logC = np.log(np.sqrt(2*np.pi))
+
+#Rough size in bytes of each temporary the likelihood kernels allocate per chunk of the data, and
+#rows per chunk when converting a text datafile
+chunkbytes = 2**26
+chunkrows = 10**6
+
+#Smallest relative likelihood change and projected gradient the L-BFGS backend's solves stop on,
+#the gradient (relative to the likelihood) below which a fit counts as converged, and the most
+#solves per fit
+lbfgsftol = 1e-12
+lbfgsgtol = 1e-8
+lbfgsgradtol = 1e-6
+lbfgsrestarts = 5
+
+#---instrumentation---#
+
+#Opt-in tracing of the fits. When tracing is on, the backends append events (dicts) to traceevents,
+#which the caller drains and writes out as JSON lines. Events about one replicate carry its row in the batch
+tracing = False
+traceevents = []
 
 #---functions---#
 
+def traceevent(event, **fields):
+    '''Records a trace event if tracing is on, does nothing otherwise'''
+    if tracing:
+        fields['event'] = event
+        traceevents.append(fields)
+
+def drainevents():
+    '''Returns the recorded trace events and starts a new list'''
+    global traceevents
+    events, traceevents = traceevents, []
+    return events
+
+def tracefits(method, fit, rowtime, **widths):
+    '''One trace event per replicate with its outcome, share of the fit time and final widths'''
+    if not tracing:
+        return
+    for i in range(len(fit['loglike'])):
+        traceevent('fit', row=i, method=method, time=float(rowtime[i]), loglike=float(fit['loglike'][i]), a=float(fit['a'][i]),
+                alpha=float(fit['alpha'][i]), converged=bool(fit['converged'][i]), nfev=int(fit['nfev'][i]), nedge=int(fit['nedge'][i]),
+                **{k : float(v[i]) for k, v in widths.items()})
+
+def istable(deviationdata):
+    '''Whether a datafile is a processed table, a regular file whose header has epistasis and separation columns'''
+    if not os.path.isfile(deviationdata):
+        return False
+    with open(deviationdata, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+    return 'epistasis' in header and 'separation' in header
+
 def dataload(deviationdata, outlier):
-    '''Loads the data'''
-    rawdata = np.loadtxt(deviationdata, skiprows=1)
-    devdata = rawdata[::,0]
-    sepdata = rawdata[::,1]
+    '''
+    Loads the data. A .npy file (see dataconvert) is memory-mapped rather than read, and the
+    epistasis and separation columns of a processed table are taken from its cache (tablecache.py)
+    '''
+    if deviationdata.endswith('.npy'):
+        devdata, sepdata = np.load(deviationdata, mmap_mode='r')
+    elif istable(deviationdata):
+        devdata, sepdata = loadcolumns(deviationdata, ['epistasis', 'separation'])
+    else:
+        rawdata = np.loadtxt(deviationdata, skiprows=1)
+        devdata = rawdata[::,0]
+        sepdata = rawdata[::,1]
     if outlier:
         sepdatamax = np.where(sepdata == sepdata.max())[0][0]
         #removes outlier, this is specific to binding
@@ -22,22 +94,125 @@ def dataload(deviationdata, outlier):
         sepdata = np.delete(sepdata, sepdatamax)
     return devdata, sepdata
 
+def dataconvert(deviationdata, npyfile, rows=chunkrows):
+    '''
+    Converts a text datafile to a (2, n) .npy file of epistasis and separation that dataload
+    memory-maps. The text is read rows lines at a time, so the file never has to fit in memory
+    '''
+    with open(deviationdata, 'r') as f:
+        n = sum(1 for line in f if line.strip()) - 1
+    out = np.lib.format.open_memmap(npyfile, mode='w+', dtype=float, shape=(2, n))
+    done = 0
+    with open(deviationdata, 'r') as f:
+        f.readline()
+        lines = filter(str.strip, f)
+        while done < n:
+            chunk = np.loadtxt(islice(lines, rows), ndmin=2)
+            out[:, done:done + len(chunk)] = chunk[:, :2].T
+            done += len(chunk)
+    out.flush()
+    return n
+
+def chunks(n, width):
+    '''Slices covering range(n) in pieces of at most width'''
+    width = max(int(width), 1)
+    return [slice(i, min(i + width, n)) for i in range(0, n, width)]
+
 def loglikenull(x):
     '''generates log-liklihood for the null model'''
+    from scipy.stats import norm
     return np.sum(np.log(norm.pdf(x, loc=np.mean(x), scale=np.std(x))))
 
 def loglikealt1(x,rset, a = 1.7349999, alpha = 0.0327):
     '''generates the log-liklihood for the alternative model'''
+    from scipy.stats import norm
     return np.sum(np.log(norm.pdf(x, loc=np.mean(x), scale=f(a,alpha,rset))))
 
 
 def loglikeall(x,rset, a = 1.73499999, alpha = 0.0327):
+    from scipy.stats import norm
     return np.sum(norm.logpdf(x, loc=np.mean(x), scale=f(a,alpha,rset)))
 
 def f(a,alpha,x):
     '''first guess for alternative'''
     return a*np.exp(-alpha*x)
 
+def loglikegrid(x, rset, a_set, alpha_set):
+    '''
+    Returns the log-likelihood of every (a, alpha) pair on the grid. Element-wise this is the same
+    arithmetic as norm.logpdf so the argmax matches loglikeall, cells with a non-positive scale are
+    nan (as scipy returns them). The grid is evaluated a few rows of a at a time so each temporary
+    stays around chunkbytes; only when one row of a is larger than that are the data split as well.
+    '''
+    a_set = np.asarray(a_set, dtype=float)
+    alpha_set = np.asarray(alpha_set, dtype=float)
+    n = len(x)
+    dev = x - np.mean(x)
+    cell = 8*len(alpha_set)
+    cols = chunks(n, chunkbytes/cell) if cell*n > chunkbytes else [slice(0, n)]
+    likelihood = np.zeros((len(a_set), len(alpha_set)))
+    for rows in chunks(len(a_set), chunkbytes/(cell*n)):
+        for part in cols:
+            scale = a_set[rows,None,None] * np.exp(-alpha_set[None,:,None] * rset[part])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                z = dev[part] / scale
+                logpdf = -z**2 / 2.0 - norm_logC - np.log(scale)
+            logpdf[~(scale > 0)] = np.nan
+            likelihood[rows] += np.sum(logpdf, axis=-1)
+    return likelihood
+
+def gridbest(likelihoodMatrix, a_set, alpha_set, numiter):
+    '''
+    Picks the best (a, alpha) from a likelihood grid, warns if it sits on the edge
+    '''
+    bestlikelihood = np.where(likelihoodMatrix == np.nanmax(likelihoodMatrix))
+    a_best_loc = bestlikelihood[0][0]
+    alpha_best_loc = bestlikelihood[1][0]
+    if a_best_loc == 0 or a_best_loc == len(a_set) - 1:
+        print("WARNING: BEST FIT FOR \"A\" TAKEN FROM END OF ARRAY {:d}".format(numiter))
+    if alpha_best_loc == 0 or alpha_best_loc == len(alpha_set) -1:
+        print("WARNING: BEST FIT FOR \"ALPHA\" TAKEN FROM EDGE OF ARRAY {:d}".format(numiter))
+    return a_set[a_best_loc], alpha_set[alpha_best_loc]
+
+def loglikegridbatch(X, rset, A, ALPHA):
+    '''
+    Log-likelihood grids for a block of datasets at once.
+    X is (nrep, n), rset is shared (n,) or per replicate (nrep, n), A and ALPHA are per-replicate
+    grids (nrep, na) and (nrep, nalpha), returns (nrep, na, nalpha). Uses sum(logpdf) = -S(alpha)/(2a^2) - n*log(a) + alpha*sum(r) - n*logC
+    with S(alpha) = sum((x-mean)^2 * exp(2*alpha*r)), so the data is only touched once per alpha.
+    S is summed over chunks of the columns so the temporaries stay around chunkbytes, X and rset can
+    be memory-mapped. Matches loglikegrid to rounding.
+    '''
+    nrep, n = X.shape
+    mean = X.mean(axis=1, keepdims=True)
+    rset = np.asarray(rset)
+    S = np.zeros(ALPHA.shape)
+    for cols in chunks(n, chunkbytes/(8*nrep*(ALPHA.shape[1] + 1))):
+        d2 = (X[:,cols] - mean)**2
+        S += np.einsum('bn,bjn->bj', d2, np.exp(2*ALPHA[:,:,None]*rset[...,None,cols]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        loglike = (-S[:,None,:] / (2*A[:,:,None]**2) - n*np.log(A)[:,:,None]
+                    + ALPHA[:,None,:]*np.sum(rset, axis=-1)[...,None,None] - n*norm_logC)
+    loglike[~(A > 0)] = np.nan
+    return loglike
+
+def gridbestbatch(likelihoodBlock, A, ALPHA, a_mask, alpha_mask):
+    '''
+    Picks the best (a, alpha) of every replicate, same tie-breaking as gridbest.
+    The masks flag which grid entries each replicate actually has (see arangebatch).
+    Returns the best points, their likelihoods, the spread of finite likelihoods on each grid
+    and whether each best point sits on the edge in a / alpha
+    '''
+    nrep, na, nalpha = likelihoodBlock.shape
+    valid = a_mask[:,:,None] & alpha_mask[:,None,:] & ~np.isnan(likelihoodBlock)
+    flat = np.where(valid, likelihoodBlock, -np.inf).reshape(nrep, -1)
+    lowest = np.min(np.where(np.isfinite(flat), flat, np.inf), axis=1)
+    best_loc = np.argmax(flat, axis=1)
+    a_best_loc, alpha_best_loc = np.unravel_index(best_loc, (na, nalpha))
+    a_edge = (a_best_loc == 0) | (a_best_loc == a_mask.sum(axis=1) - 1)
+    alpha_edge = (alpha_best_loc == 0) | (alpha_best_loc == alpha_mask.sum(axis=1) - 1)
+    rows = np.arange(nrep)
+    return A[rows, a_best_loc], ALPHA[rows, alpha_best_loc], flat[rows, best_loc], flat[rows, best_loc] - lowest, a_edge, alpha_edge
 
 def parameterSearchRecursive(x,rset,init_a,delta_a,init_alpha,delta_alpha, numiter):
     '''
@@ -48,19 +223,8 @@ def parameterSearchRecursive(x,rset,init_a,delta_a,init_alpha,delta_alpha, numit
     else:
         a_set = np.arange(init_a - delta_a,init_a + delta_a, delta_a/12)
         alpha_set = np.arange(init_alpha - delta_alpha, init_alpha + delta_alpha, delta_alpha/10)
-        likelihoodMatrix = np.zeros([a_set.size, alpha_set.size])
-        for i in range(a_set.size):
-            for j in range(alpha_set.size):
-                likelihoodMatrix[i,j] = loglikeall(x,rset,a = a_set[i], alpha = alpha_set[j])
-        bestlikelihood = np.where(likelihoodMatrix == np.nanmax(likelihoodMatrix))
-        a_best_loc = bestlikelihood[0][0]
-        alpha_best_loc = bestlikelihood[1][0]
-        if a_best_loc == 0 or a_best_loc == len(a_set) - 1:
-            print("WARNING: BEST FIT FOR \"A\" TAKEN FROM END OF ARRAY {:d}".format(numiter))
-        if alpha_best_loc == 0 or alpha_best_loc == len(alpha_set) -1:
-            print("WARNING: BEST FIT FOR \"ALPHA\" TAKEN FROM EDGE OF ARRAY {:d}".format(numiter))
-        a_best = a_set[a_best_loc]
-        alpha_best = alpha_set[alpha_best_loc]
+        likelihoodMatrix = loglikegrid(x, rset, a_set, alpha_set)
+        a_best, alpha_best = gridbest(likelihoodMatrix, a_set, alpha_set, numiter)
         return parameterSearchRecursive(x,rset,a_best,delta_a * 0.5, alpha_best, delta_alpha * 0.5, numiter -1 )
 
 def likelihoodSearchRecursive(x,rset,init_a,delta_a,init_alpha,delta_alpha, numiter, scalefactor=8):
@@ -68,25 +232,230 @@ def likelihoodSearchRecursive(x,rset,init_a,delta_a,init_alpha,delta_alpha, numi
     Returns maximum likelihood via recursion
     '''
     if numiter == 0:
+        from scipy.stats import norm
         return np.sum(norm.logpdf(x,x.mean(),f(init_a, init_alpha,rset)))
     else:
         a_set = np.arange(init_a - delta_a,init_a + delta_a, delta_a/scalefactor)
         alpha_set = np.arange(init_alpha - delta_alpha, init_alpha + delta_alpha, delta_alpha/scalefactor)
-        likelihoodMatrix = np.zeros([a_set.size, alpha_set.size])
-        for i in range(a_set.size):
-            for j in range(alpha_set.size):
-                likelihoodMatrix[i,j] = loglikeall(x,rset,a = a_set[i], alpha = alpha_set[j])
-        bestlikelihood = np.where(likelihoodMatrix == np.nanmax(likelihoodMatrix))
-        a_best_loc = bestlikelihood[0][0]
-        alpha_best_loc = bestlikelihood[1][0]
-        if a_best_loc == 0 or a_best_loc == len(a_set) - 1:
-            print("WARNING: BEST FIT FOR \"A\" TAKEN FROM END OF ARRAY {:d}".format(numiter))
-        if alpha_best_loc == 0 or alpha_best_loc == len(alpha_set) -1:
-            print("WARNING: BEST FIT FOR \"ALPHA\" TAKEN FROM EDGE OF ARRAY {:d}".format(numiter))
-        a_best = a_set[a_best_loc]
-        alpha_best = alpha_set[alpha_best_loc]
+        likelihoodMatrix = loglikegrid(x, rset, a_set, alpha_set)
+        a_best, alpha_best = gridbest(likelihoodMatrix, a_set, alpha_set, numiter)
         return likelihoodSearchRecursive(x,rset,a_best,delta_a/scalefactor, alpha_best, delta_alpha/scalefactor, numiter -1, scalefactor=scalefactor)
 
+def arangebatch(start, stop, step):
+    '''
+    Row-wise np.arange for vectors of start/stop/step. Rounding can give rows different lengths,
+    so returns the padded grid and a mask of the entries np.arange would have produced
+    '''
+    step = np.asarray(step, dtype=float)[...,None]
+    counts = np.ceil((stop - start)/step[...,0]).astype(int)
+    steps = np.arange(counts.max())
+    return start[:,None] + steps*step, steps < counts[:,None]
+
+def rowsof(rset, rows):
+    '''
+    The given rows of rset, which is either shared by all replicates (1-D) or one row per replicate.
+    Asking for every row returns rset itself rather than a copy, which matters for memory-mapped data
+    '''
+    if np.ndim(rset) == 1 or (isinstance(rows, np.ndarray) and rows.size == len(rset)):
+        return rset
+    return rset[rows]
+
+def weightsums(X, mean, rset, alpha):
+    '''
+    S(alpha) = sum((x-mean)^2*exp(2*alpha*r)) for every row and its first two derivatives in alpha,
+    summed over chunks of the columns like loglikegridbatch
+    '''
+    nrep, n = X.shape
+    S = np.zeros((3, nrep))
+    with np.errstate(over='ignore', invalid='ignore'):
+        for cols in chunks(n, chunkbytes/(8*3*nrep)):
+            r = rset[...,cols]
+            w = (X[:,cols] - mean[:,None])**2 * np.exp(2*alpha[:,None]*r)
+            S += [w.sum(axis=1), 2*(w*r).sum(axis=1), 4*(w*r**2).sum(axis=1)]
+    return S
+
+def fitresult(loglike, a, alpha, converged, nfev, nedge):
+    '''Per-replicate outcome of a fit, shared by all the optimizer backends'''
+    return {'loglike' : loglike, 'a' : a, 'alpha' : alpha, 'converged' : converged, 'nfev' : nfev, 'nedge' : nedge}
+
+def fitgrid(X,rset,init_a,delta_a,init_alpha,delta_alpha, numiter, scalefactor=8, tol=0.0):
+    '''
+    Grid backend: the same levels as likelihoodSearchRecursive for every row of X at once.
+    A replicate whose best point is on the edge of its grid is re-centred there without shrinking
+    (at most numiter times) instead of being narrowed around a bad point, and a replicate stops
+    once the likelihood varies by no more than tol over its whole grid. Grids flat to within the
+    rounding of an n-term sum are taken as resolved, their argmax (and any edge hit) is just noise
+    '''
+    nrep, n = X.shape
+    a_best = np.full(nrep, float(init_a))
+    alpha_best = np.full(nrep, float(init_alpha))
+    da = np.full(nrep, float(delta_a))
+    dalpha = np.full(nrep, float(delta_alpha))
+    levels = np.full(nrep, numiter)
+    shifts = np.full(nrep, numiter)
+    loglike = np.full(nrep, -np.inf)
+    onedge = np.zeros(nrep, dtype=bool)
+    nfev = np.zeros(nrep, dtype=int)
+    nedge = np.zeros(nrep, dtype=int)
+    rowtime = np.zeros(nrep)
+    level = 0
+    while np.any(levels > 0):
+        start = time.perf_counter()
+        rows = np.flatnonzero(levels > 0)
+        A, a_mask = arangebatch(a_best[rows] - da[rows], a_best[rows] + da[rows], da[rows]/scalefactor)
+        ALPHA, alpha_mask = arangebatch(alpha_best[rows] - dalpha[rows], alpha_best[rows] + dalpha[rows], dalpha[rows]/scalefactor)
+        likelihoodBlock = loglikegridbatch(rowsof(X, rows), rowsof(rset, rows), A, ALPHA)
+        nfev[rows] += a_mask.sum(axis=1)*alpha_mask.sum(axis=1)
+        a_new, alpha_new, best, spread, a_edge, alpha_edge = gridbestbatch(likelihoodBlock, A, ALPHA, a_mask, alpha_mask)
+        flat = spread <= np.maximum(tol, n*np.finfo(float).eps*np.abs(best))
+        edge = (a_edge | alpha_edge) & ~flat
+        a_best[rows] = a_new
+        alpha_best[rows] = alpha_new
+        loglike[rows] = best
+        onedge[rows] = edge
+        nedge[rows] += edge
+        shift = edge & (shifts[rows] > 0)
+        shrink = rows[~shift]
+        shifts[rows[shift]] -= 1
+        levels[shrink] -= 1
+        da[shrink] /= scalefactor
+        dalpha[shrink] /= scalefactor
+        levels[rows[flat]] = 0
+        if tracing:
+            elapsed = time.perf_counter() - start
+            rowtime[rows] += elapsed/rows.size
+            traceevent('level', method='grid', level=level, rows=int(rows.size), time=elapsed,
+                    evals=int(np.sum(a_mask.sum(axis=1)*alpha_mask.sum(axis=1))), edges=int(np.sum(edge)))
+            for axis, hit in (('a', a_edge & edge), ('alpha', alpha_edge & edge)):
+                for i in np.flatnonzero(hit):
+                    traceevent('edge', row=int(rows[i]), level=level, axis=axis, a=float(a_new[i]), alpha=float(alpha_new[i]))
+        level += 1
+    loglike = loglikegridbatch(X, rset, a_best[:,None], alpha_best[:,None])[:,0,0]
+    fit = fitresult(loglike, a_best, alpha_best, ~onedge, nfev + 1, nedge)
+    tracefits('grid', fit, rowtime, width_a=da, width_alpha=dalpha)
+    return fit
+
+def fitprofile(X,rset,init_a,delta_a,init_alpha,delta_alpha, numiter, scalefactor=8, tol=0.0, maxiter=100):
+    '''
+    Profile backend: for fixed alpha the best a is sqrt(S(alpha)/n), leaving the 1-D profile
+    pl(alpha) = -n/2 - n/2*log(S(alpha)/n) + alpha*sum(r) - n*logC, which is concave in alpha.
+    Maximised for every row at once by Newton steps with step halving; a replicate stops once a
+    step improves its likelihood by no more than tol. The grid arguments only set the starting alpha
+    '''
+    nrep, n = X.shape
+    mean = X.mean(axis=1)
+    rsum = np.broadcast_to(np.sum(rset, axis=-1), (nrep,))
+    def profile(rows, alpha):
+        S, S1, S2 = weightsums(rowsof(X, rows), mean[rows], rowsof(rset, rows), alpha)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            pl = -n/2*(1 + np.log(S/n)) + alpha*rsum[rows] - n*norm_logC
+            grad = -n/2*S1/S + rsum[rows]
+            hess = -n/2*(S2*S - S1**2)/S**2
+        return np.where(np.isfinite(pl), pl, -np.inf), grad, hess
+    alpha = np.full(nrep, float(init_alpha))
+    loglike, grad, hess = profile(np.arange(nrep), alpha)
+    nfev = np.ones(nrep, dtype=int)
+    converged = np.zeros(nrep, dtype=bool)
+    laststep = np.full(nrep, np.inf)
+    rowtime = np.zeros(nrep)
+    for it in range(maxiter):
+        start = time.perf_counter()
+        rows = np.flatnonzero(~converged)
+        if rows.size == 0:
+            break
+        evals = np.sum(nfev[rows])
+        step = np.where(hess[rows] < 0, -grad[rows]/hess[rows], np.sign(grad[rows]))
+        step[~np.isfinite(step)] = 0
+        improved = np.zeros(rows.size, dtype=bool)
+        for halving in range(60):
+            todo = np.flatnonzero(~improved)
+            if todo.size == 0:
+                break
+            trial = alpha[rows[todo]] + step[todo]
+            pl, g, h = profile(rows[todo], trial)
+            nfev[rows[todo]] += 1
+            ok = pl >= loglike[rows[todo]]
+            gain = pl - loglike[rows[todo]]
+            done = rows[todo[ok]]
+            laststep[done] = np.abs(trial[ok] - alpha[done])
+            alpha[done] = trial[ok]
+            grad[done] = g[ok]
+            hess[done] = h[ok]
+            loglike[done] = pl[ok]
+            converged[done] = gain[ok] <= tol
+            improved[todo[ok]] = True
+            step[todo[~ok]] /= 2
+        converged[rows[~improved]] = True
+        if tracing:
+            elapsed = time.perf_counter() - start
+            rowtime[rows] += elapsed/rows.size
+            traceevent('level', method='profile', level=it, rows=int(rows.size), time=elapsed, evals=int(np.sum(nfev[rows]) - evals))
+    S = weightsums(X, mean, rset, alpha)[0]
+    fit = fitresult(loglike, np.sqrt(S/n), alpha, converged & np.isfinite(loglike), nfev, np.zeros(nrep, dtype=int))
+    tracefits('profile', fit, rowtime, width_alpha=laststep)
+    return fit
+
+def fitlbfgs(X,rset,init_a,delta_a,init_alpha,delta_alpha, numiter, scalefactor=8, tol=0.0, maxiter=500):
+    '''
+    L-BFGS backend: maximises the full likelihood over (a, alpha) with its analytic gradient
+    dl/da = S/a^3 - n/a, dl/dalpha = -S'(alpha)/(2a^2) + sum(r). Solved with scipy per row,
+    stopping once an iteration improves the likelihood by no more than tol; a row has converged
+    when the gradient at its solution vanishes (to lbfgsgradtol relative to the likelihood)
+    '''
+    from scipy.optimize import minimize
+    nrep, n = X.shape
+    mean = X.mean(axis=1)
+    rsum = np.broadcast_to(np.sum(rset, axis=-1), (nrep,))
+    loglike, a, alpha = np.zeros(nrep), np.zeros(nrep), np.zeros(nrep)
+    converged = np.zeros(nrep, dtype=bool)
+    nfev = np.zeros(nrep, dtype=int)
+    rowtime = np.zeros(nrep)
+    for i in range(nrep):
+        started = time.perf_counter()
+        def negloglike(params):
+            S, S1 = weightsums(X[i:i+1], mean[i:i+1], rowsof(rset, slice(i, i+1)), params[1:])[:2]
+            ll = -S[0]/(2*params[0]**2) - n*np.log(params[0]) + params[1]*rsum[i] - n*norm_logC
+            grad = np.array([S[0]/params[0]**3 - n/params[0], -S1[0]/(2*params[0]**2) + rsum[i]])
+            if not np.isfinite(ll):
+                return np.inf, np.zeros(2)
+            return -ll, -grad
+        params = np.array([float(init_a), float(init_alpha)])
+        value = negloglike(params)[0]
+        nfev[i] = 1
+        #scipy's ftol is relative to the likelihood where a solve starts, so a solve starting far off
+        #can stop early, and one at the optimum can end on a failed line search. Convergence is judged
+        #from the gradient at the solution instead, solving again from there while that still helps
+        for attempt in range(lbfgsrestarts):
+            ftol = max(tol/max(abs(value), 1) if np.isfinite(value) else tol, lbfgsftol)
+            res = minimize(negloglike, params, jac=True, method='L-BFGS-B', bounds=[(1e-12, None), (None, None)],
+                    options={'ftol' : ftol, 'gtol' : lbfgsgtol, 'maxiter' : maxiter})
+            nfev[i] += res.nfev
+            gain = value - res.fun
+            params, value = res.x, res.fun
+            converged[i] = np.isfinite(value) and np.max(np.abs(res.jac)) <= lbfgsgradtol*max(abs(value), 1)
+            if converged[i] or not gain > tol:
+                break
+        a[i], alpha[i] = params
+        loglike[i] = -value
+        rowtime[i] = time.perf_counter() - started
+    fit = fitresult(loglike, a, alpha, converged, nfev, np.zeros(nrep, dtype=int))
+    tracefits('lbfgs', fit, rowtime)
+    return fit
+
+optimizers = {'grid' : fitgrid, 'profile' : fitprofile, 'lbfgs' : fitlbfgs}
+
+def fitaltbatch(X,rset,init_a,delta_a,init_alpha,delta_alpha, numiter, scalefactor=8, method='grid', tol=0.0):
+    '''
+    Fits the alternative model to every row of X with the chosen optimizer backend. rset is either
+    shared by all rows or has one row of separations per row of X.
+    Returns a dict of per-replicate arrays (loglike, a, alpha, converged, nfev, nedge)
+    '''
+    return optimizers[method](X, rset, init_a, delta_a, init_alpha, delta_alpha, numiter, scalefactor=scalefactor, tol=tol)
+
+def fitalt(x,rset,init_a,delta_a,init_alpha,delta_alpha, numiter, scalefactor=8, method='grid', tol=0.0):
+    '''Single dataset version of fitaltbatch, returns the dict with scalar entries'''
+    fit = fitaltbatch(x[None,:], rset, init_a, delta_a, init_alpha, delta_alpha, numiter, scalefactor=scalefactor, method=method, tol=tol)
+    return {k : v[0] for k, v in fit.items()}
 
 def modelgenalt1(devdata, sepdata, a, alpha):
     devmean = devdata.mean()
@@ -102,17 +471,194 @@ def loglikeratiotest(null,alt):
 def nullgen(mean, std, num):
     return np.random.normal(mean, std, num)
 
-def modelgen3(devdata,sepdata,ada,alphadalpha,niter,scalefactor):
+def modelgen3(devdata,sepdata,ada,alphadalpha,niter,scalefactor,rng=None):
+    rng = np.random if rng is None else rng
     devmean = devdata.mean()
     devstd = devdata.std()
     ai,da = ada.split(',')
     alphai,dalpha = alphadalpha.split(',')
-    null1 = np.random.normal(loc=devmean, scale=np.std(devdata,ddof=1), size=len(devdata))
+    null1 = rng.normal(loc=devmean, scale=np.std(devdata,ddof=1), size=len(devdata))
     loglikenull1 = loglikeall(null1, sepdata, a = np.std(null1,ddof=1), alpha = 0)
     loglikealt = likelihoodSearchRecursive(null1, sepdata, float(ai), float(da), float(alphai), float(dalpha), niter,scalefactor=scalefactor)
     lam = loglikenull1 - loglikealt
     return lam
 
+def modelgen3batch(devdata,sepdata,ada,alphadalpha,niter,scalefactor,nrep,rng=None,method='grid',tol=0.0):
+    '''
+    Block version of modelgen3, draws nrep null datasets as one (nrep, n) array and fits them together.
+    Draws come off rng (the global state by default) in the same order as nrep calls to modelgen3.
+    Returns the lambdas and the fit dict from fitaltbatch
+    '''
+    rng = np.random if rng is None else rng
+    devmean = devdata.mean()
+    ai,da = ada.split(',')
+    alphai,dalpha = alphadalpha.split(',')
+    null1 = rng.normal(loc=devmean, scale=np.std(devdata,ddof=1), size=(nrep, len(devdata)))
+    nullscale = np.std(null1, ddof=1, axis=1)[:,None]
+    loglikenull1 = loglikegridbatch(null1, sepdata, nullscale, np.zeros_like(nullscale))[:,0,0]
+    fit = fitaltbatch(null1, sepdata, float(ai), float(da), float(alphai), float(dalpha), niter, scalefactor=scalefactor, method=method, tol=tol)
+    return loglikenull1 - fit['loglike'], fit
+
+def simulateblock(devdata,sepdata,ada,alphadalpha,niter,scalefactor,block,method='grid',tol=0.0,trace=False):
+    '''
+    Simulated lambdas and fits for one (first, nrep, seed) block, drawn from its own seeded stream,
+    plus the trace events of its fits when trace is on (rows numbered as replicates from first)
+    '''
+    global tracing
+    first, nrep, seed = block
+    tracing = trace
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    lam, fit = modelgen3batch(devdata, sepdata, ada, alphadalpha, niter, scalefactor, nrep, rng=rng, method=method, tol=tol)
+    traceevent('block', first=first, nrep=nrep, method=method, time=time.perf_counter() - start, pid=os.getpid())
+    events = drainevents()
+    for e in events:
+        if 'row' in e:
+            e['replicate'] = first + e.pop('row')
+    tracing = False
+    return lam, fit, events
+
+def simulateblocks(devdata,sepdata,ada,alphadalpha,niter,scalefactor,nummodel,blocksize,workers=1,seed=None,method='grid',tol=0.0,start=0,trace=False):
+    '''
+    Yields (lambdas, fits, trace events) for nummodel simulated models block by block, in order, from block start on.
+    Every block gets its own stream spawned from a single SeedSequence, so for a given seed and
+    blocksize the output doesn't depend on how many workers the blocks are spread over, and a run
+    can be picked up again at any block
+    '''
+    firsts = range(0, nummodel, blocksize)
+    nreps = [min(blocksize, nummodel - i) for i in firsts]
+    blocks = list(zip(firsts, nreps, np.random.SeedSequence(seed).spawn(len(nreps))))[start:]
+    job = partial(simulateblock, devdata, sepdata, ada, alphadalpha, niter, scalefactor, method=method, tol=tol, trace=trace)
+    if workers > 1:
+        with Pool(workers) as pool:
+            yield from pool.imap(job, blocks)
+    else:
+        for block in blocks:
+            yield job(block)
+
+def simulate(devdata,sepdata,ada,alphadalpha,niter,scalefactor,nummodel,blocksize,workers=1,seed=None,method='grid',tol=0.0):
+    '''Returns nummodel simulated lambdas and their fits, see simulateblocks'''
+    results = list(simulateblocks(devdata, sepdata, ada, alphadalpha, niter, scalefactor, nummodel, blocksize, workers=workers, seed=seed, method=method, tol=tol))
+    lamset = np.concatenate([lam for lam, fit, events in results])
+    fits = {k : np.concatenate([fit[k] for lam, fit, events in results]) for k in results[0][1]}
+    return lamset, fits
+
+def writemanifest(manifestfile, manifest):
+    '''Writes the progress manifest via a temporary file so a crash never leaves it half written'''
+    with open(manifestfile + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifestfile + '.tmp', manifestfile)
+
+def pvalueinterval(nextreme, nsim, confidence=0.99):
+    '''
+    Monte Carlo p-value (nextreme+1)/(nsim+1) for nextreme of nsim simulated lambdas at or below
+    the experimental one, with the Clopper-Pearson interval on the underlying tail probability
+    '''
+    from scipy.stats import beta
+    tail = (1 - confidence)/2
+    lower = float(beta.ppf(tail, nextreme, nsim - nextreme + 1)) if nextreme > 0 else 0.0
+    upper = float(beta.ppf(1 - tail, nextreme + 1, nsim - nextreme)) if nextreme < nsim else 1.0
+    return (nextreme + 1)/(nsim + 1), lower, upper
+
+def pvaluestop(manifest, siglevel=0.05, confidence=0.99, precision=0.0):
+    '''
+    Sequential stopping rule: true once the p-value interval lies wholly on one side of siglevel
+    or its half-width is down to precision
+    '''
+    pvalue, lower, upper = pvalueinterval(manifest['nextreme'], manifest['models_done'], confidence)
+    return upper < siglevel or lower > siglevel or (upper - lower)/2 <= precision
+
+def simulatetofile(outfile,devdata,sepdata,ada,alphadalpha,niter,scalefactor,nummodel,blocksize,workers=1,seed=None,method='grid',tol=0.0,
+        settings=None,resume=False,exp=None,stop=None,trace=None):
+    '''
+    Streams simulated lambdas to outfile one block at a time, flushing after every block and
+    recording progress in outfile.manifest. With resume the run continues after the last block the
+    manifest records as complete, anything written past it is dropped. settings (e.g. the run
+    arguments) are stored in the manifest and must match on resume. If exp is given the manifest
+    counts simulated lambdas at or below it, and stop(manifest) is checked after every block to end
+    the run early (see pvaluestop). If trace is an open file the trace events of every block are
+    written to it as JSON lines. Returns the final manifest
+    '''
+    manifestfile = outfile + '.manifest'
+    if resume and os.path.exists(manifestfile):
+        with open(manifestfile, 'r') as f:
+            manifest = json.load(f)
+        if manifest['settings'] != settings or (seed is not None and seed != manifest['seed']):
+            raise ValueError("Settings in {:s} don't match this run, can't resume".format(manifestfile))
+    else:
+        seed = np.random.SeedSequence(seed).entropy
+        manifest = {'settings' : settings, 'seed' : seed, 'blocks_done' : 0, 'models_done' : 0, 'offset' : 0,
+                    'unconverged' : 0, 'nedge' : 0, 'nfev' : 0, 'min' : None, 'exp' : exp, 'nextreme' : 0}
+    print("Seed: {:d}".format(manifest['seed']))
+    if manifest['blocks_done']:
+        print("Resuming after {:d} of {:d} models".format(manifest['models_done'], nummodel))
+        if stop is not None and stop(manifest):
+            return manifest
+    with open(outfile, 'r+' if manifest['offset'] else 'w') as f:
+        f.truncate(manifest['offset'])
+        f.seek(manifest['offset'])
+        for lam, fit, events in simulateblocks(devdata, sepdata, ada, alphadalpha, niter, scalefactor, nummodel, blocksize, workers=workers,
+                seed=manifest['seed'], method=method, tol=tol, start=manifest['blocks_done'], trace=trace is not None):
+            if trace is not None:
+                trace.write(''.join(json.dumps(e) + '\n' for e in events))
+                trace.flush()
+            f.write(''.join("{:f}\n".format(l) for l in lam))
+            f.flush()
+            os.fsync(f.fileno())
+            manifest['blocks_done'] += 1
+            manifest['models_done'] += len(lam)
+            manifest['offset'] = f.tell()
+            manifest['unconverged'] += int(np.sum(~fit['converged']))
+            manifest['nedge'] += int(np.sum(fit['nedge']))
+            manifest['nfev'] += int(np.sum(fit['nfev']))
+            manifest['min'] = float(np.min(lam)) if manifest['min'] is None else min(manifest['min'], float(np.min(lam)))
+            if exp is not None:
+                manifest['nextreme'] += int(np.sum(lam <= exp))
+            writemanifest(manifestfile, manifest)
+            if stop is not None and stop(manifest):
+                break
+    return manifest
+
+def tracesummary(tracefile, slowest=5):
+    '''
+    Summary of the simulation events in a trace file: time and evaluations per level, edge hits
+    per axis, the slowest replicates and the unconverged ones
+    '''
+    with open(tracefile, 'r') as f:
+        events = [e for e in map(json.loads, filter(str.strip, f)) if e.get('replicate') != 'exp']
+    levels = {}
+    edges = {}
+    fits = []
+    blocks = [e for e in events if e['event'] == 'block']
+    for e in events:
+        if e['event'] == 'level':
+            entry = levels.setdefault((e['method'], e['level']), [0, 0.0, 0, 0])
+            entry[0] += e['rows']
+            entry[1] += e['time']
+            entry[2] += e['evals']
+            entry[3] += e.get('edges', 0)
+        elif e['event'] == 'edge':
+            edges[e['axis']] = edges.get(e['axis'], 0) + 1
+        elif e['event'] == 'fit':
+            fits.append(e)
+    lines = ["Trace: {:d} blocks, {:d} fits, {:.3f} s in blocks".format(len(blocks), len(fits), sum(e['time'] for e in blocks))]
+    lines.append("method\tlevel\trows\ttime\tevals\tedges")
+    for (method, level), (rows, t, evals, nedge) in sorted(levels.items()):
+        lines.append("{:s}\t{:d}\t{:d}\t{:.4f}\t{:d}\t{:d}".format(method, level, rows, t, evals, nedge))
+    lines.append("Edge hits: " + (", ".join("{:s} {:d}".format(axis, count) for axis, count in sorted(edges.items())) or "none"))
+    if fits:
+        lines.append("Evaluations per fit: {:.1f}".format(np.mean([e['nfev'] for e in fits])))
+        lines.append("Slowest replicates:")
+        for e in sorted(fits, key=lambda e: e['time'], reverse=True)[:slowest]:
+            lines.append("  {}: {:.4g} s, {:d} evals, {:d} edge hits, a = {:f}, alpha = {:f}, converged: {}".format(
+                e['replicate'], e['time'], e['nfev'], e['nedge'], e['a'], e['alpha'], e['converged']))
+        unconverged = [e['replicate'] for e in fits if not e['converged']]
+        lines.append("Unconverged replicates: {:d}{:s}".format(len(unconverged),
+            (" (" + ", ".join(str(r) for r in unconverged[:20]) + (", ..." if len(unconverged) > 20 else "") + ")") if unconverged else ""))
+    return '\n'.join(lines)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--datfile',
@@ -125,11 +671,18 @@ if __name__ == '__main__':
     parser.add_argument('--out',
             type    =   str,
             default =   'output.txt',
-            help    =   "Output file for simulated lambda")
+            help    =   "Output file for simulated lambda, progress is kept next to it in <out>.manifest")
+    parser.add_argument('--expout',
+            type    =   str,
+            default =   'exp.txt',
+            help    =   "Output file for the experimental lambda")
+    parser.add_argument('--resume',
+            action  =   'store_true',
+            help    =   "Continue an interrupted run from the last block recorded in <out>.manifest")
     parser.add_argument('--alphadalpha',
             type    =   str,
             default =   '1,0.5',
-            help    =   "Initial estimate for alpha and delta"
+            help    =   "Initial estimate for alpha and delta")
     parser.add_argument('--ada',
             type    =   str,
             default =   '1,3',
@@ -144,25 +697,96 @@ if __name__ == '__main__':
             help    =   "The fraction and number of estimates")
     parser.add_argument('--outlier',
             action  = 'store_true',
-            help    =   "If outlier exists, will delete from dataset"
+            help    =   "If outlier exists, will delete from dataset")
+    parser.add_argument('--blocksize',
+            type    =   int,
+            default =   500,
+            help    =   "Number of simulated models drawn and fit together")
+    parser.add_argument('--workers',
+            type    =   int,
+            default =   1,
+            help    =   "Number of processes to spread the simulation blocks over")
+    parser.add_argument('--seed',
+            type    =   int,
+            default =   None,
+            help    =   "Seed for the simulations, a fresh one is drawn and printed if not given")
+    parser.add_argument('--method',
+            type    =   str,
+            default =   'grid',
+            choices =   sorted(optimizers),
+            help    =   "Optimizer for the alternative model: grid refinement, profile likelihood in alpha or L-BFGS")
+    parser.add_argument('--tol',
+            type    =   float,
+            default =   0.0,
+            help    =   "Stop a fit once an iteration can improve the log-likelihood by no more than this")
+    parser.add_argument('--sequential',
+            action  =   'store_true',
+            help    =   "Stop simulating, with --nummodel as the cap, once the p-value is resolved against --siglevel or to --precision")
+    parser.add_argument('--siglevel',
+            type    =   float,
+            default =   0.05,
+            help    =   "Significance level the p-value is compared to in sequential mode")
+    parser.add_argument('--confidence',
+            type    =   float,
+            default =   0.99,
+            help    =   "Confidence of the p-value interval")
+    parser.add_argument('--precision',
+            type    =   float,
+            default =   0.0,
+            help    =   "In sequential mode also stop once the p-value interval half-width is down to this")
+    parser.add_argument('--convert',
+            type    =   str,
+            default =   None,
+            help    =   "Convert --datfile to a memory-mappable .npy file at this path and exit. Pass the .npy as --datfile for large datasets")
+    parser.add_argument('--trace',
+            type    =   str,
+            default =   None,
+            help    =   "If given, writes per-level, edge and per-replicate fit events here as JSON lines and prints a summary")
     if len(sys.argv) == 1:
         parser.print_help()
         sys.exit(1)
     args = parser.parse_args()
+    if args.nummodel < 1 and args.convert is None:
+        parser.error("--nummodel must be at least 1")
+    if args.blocksize < 1:
+        parser.error("--blocksize must be at least 1")
+    if args.convert is not None:
+        print("Converted {:d} rows to {:s}".format(dataconvert(args.datfile, args.convert), args.convert))
+        sys.exit(0)
     dev,sep = dataload(args.datfile, outlier=args.outlier)
     ai, da = args.ada.split(',')
     alphai,dalpha = args.alphadalpha.split(',')
-    expnull = loglikenull(dev)
-    expalt = likelihoodSearchRecursive(dev, sep, float(ai), float(da), float(alphai), float(dalpha), args.numiter, scalefactor=args.scale)
-    exp = expnull - expalt
-    #Generate set of likelihood ratios. NOTE: THis can return a ton of errors, this is most likely because you've already found the 
-    #Optimal likelihood and all adjacent estimates are within error.
-    lamset = [ modelgen3(dev, sep, args.ada, args.alphadalpha,args.numiter,scalefactor=args.scale) for i in range(args.nummodel) ]
-    print("Exp: {:f}".format(exp))
-    print("Min of sims: {:f}".format(min(lamset)))
-    with open('exp.txt', 'w') as f:
+    #Null log-likelihood through the chunked kernel, same as loglikenull without full-length temporaries
+    expnull = loglikegridbatch(dev[None,:], sep, np.array([[np.std(dev)]]), np.zeros((1, 1)))[0,0,0]
+    trace = None
+    if args.trace is not None:
+        trace = open(args.trace, 'a' if args.resume else 'w')
+        tracing = True
+    expfit = fitalt(dev, sep, float(ai), float(da), float(alphai), float(dalpha), args.numiter, scalefactor=args.scale, method=args.method, tol=args.tol)
+    exp = expnull - expfit['loglike']
+    if trace is not None:
+        for e in drainevents():
+            e.pop('row', None)
+            e['replicate'] = 'exp'
+            trace.write(json.dumps(e) + '\n')
+        tracing = False
+    print("Exp fit: a = {:f}, alpha = {:f}, converged: {}".format(expfit['a'], expfit['alpha'], expfit['converged']))
+    with open(args.expout, 'w') as f:
         f.write("{:f}".format(exp))
-    with open(args.out, 'w') as f:
-        for lam in lamset:
-            f.write("{:f}\n".format(lam))
-    
+    #Generate set of likelihood ratios. Edge hits and unconverged fits are counted in the manifest rather than printed
+    settings = {k : v for k, v in vars(args).items() if k not in ('workers', 'seed', 'resume', 'out', 'expout', 'trace', 'convert')}
+    settings['datfile'] = os.path.abspath(args.datfile)
+    stop = partial(pvaluestop, siglevel=args.siglevel, confidence=args.confidence, precision=args.precision) if args.sequential else None
+    manifest = simulatetofile(args.out, dev, sep, args.ada, args.alphadalpha, args.numiter, args.scale, args.nummodel, args.blocksize,
+            workers=args.workers, seed=args.seed, method=args.method, tol=args.tol, settings=settings, resume=args.resume, exp=exp, stop=stop, trace=trace)
+    if trace is not None:
+        trace.close()
+        print(tracesummary(args.trace))
+    pvalue, lower, upper = pvalueinterval(manifest['nextreme'], manifest['models_done'], args.confidence)
+    print("Unconverged fits: {:d} of {:d}, edge hits: {:d}, likelihood evaluations per fit: {:.1f}".format(
+        manifest['unconverged'], manifest['models_done'], manifest['nedge'], manifest['nfev']/max(manifest['models_done'], 1)))
+    print("Exp: {:f}".format(exp))
+    if manifest['min'] is not None:
+        print("Min of sims: {:f}".format(manifest['min']))
+    print("Simulations: {:d}, p-value: {:.4g}, {:g}% interval: [{:.4g}, {:.4g}]".format(
+        manifest['models_done'], pvalue, 100*args.confidence, lower, upper))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+'''
+Model search over the abstraction combinations of Epistasis_stats_final_{bind,fold}.R.
+
+Every combination of the charge, ss, hp and sasa abstractions (allcombos) is joined with the
+static features and run through stepwise AICc selection from its (features)^2 model, once per
+random ordering of the features. The selections are spread over a process pool and gathered into
+one table; the best combination of every ordering is compared (the mismatch check of the R
+scripts) and the best selected model is returned as it came out of the search.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import os
+import sys
+from functools import partial
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stepaicc'))
+from stepaicc import DesignCache, readtable, stepaicc, termlabel, olssummary, formatsummary, deltarsq
+
+#---constants---#
+
+processed = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'processed')
+
+#Features and abstractions of the two model-build scripts
+systems = {
+    'bind' : {'datfile' : os.path.join(processed, 'skempi_bind_processed.txt'),
+              'features' : ['separation', 'cplx_type', 'intside_int', 'size_net'],
+              'abstractions' : [['charge_ab1', 'charge_ab2', 'charge_ab3'], ['ss_ab1', 'ss_ab2', 'ss_ab3'],
+                                ['hp_ab1', 'hp_ab2', 'hp_ab3'], ['rel_sasa_net', 'abs_sasa_net']]},
+    'fold' : {'datfile' : os.path.join(processed, 'protherm4_fold_processed.txt'),
+              'features' : ['separation', 'num_res', 'size_net'],
+              'abstractions' : [['charge_ab1', 'charge_ab2', 'charge_ab3'], ['ss_ab1', 'ss_ab2', 'ss_ab3'],
+                                ['hp_ab1', 'hp_ab2', 'hp_ab3'], ['abs_sasa_net', 'rel_sasa_net']]},
+}
+
+#---functions---#
+
+def allcombos(features, abstractions):
+    '''
+    Feature lists of every combination of abstractions, in the order of the R scripts' nested
+    outer() calls (the first abstraction varies fastest)
+    '''
+    combos = [[]]
+    for choices in abstractions:
+        combos = [combo + [choice] for choice in choices for combo in combos]
+    return [list(features) + combo for combo in combos]
+
+def searchjob(design, response, job):
+    '''Stepwise selection for one (combo index, ordering, features, seed) job, features shuffled by the seed'''
+    combo, ordering, features, seed = job
+    order = list(np.random.default_rng(seed).permutation(features))
+    result = stepaicc(design.data, response, order, design=design)
+    return {'combo' : combo, 'ordering' : ordering, 'features' : order, 'aicc' : result['aicc'], 'rank' : result['rank'],
+            'rsquared' : result['rsquared'], 'terms' : result['terms']}
+
+def search(data, response, combos, orderings=2, workers=1, seed=None):
+    '''
+    Runs every combination under orderings random feature orders, spread over workers processes.
+    Every job has its own seed spawned from seed, so the results don't depend on workers. The
+    model matrix blocks of all features and their interactions are encoded once, here, and shared
+    by every job. Returns the records sorted by combination and ordering
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(len(combos)*orderings)
+    jobs = [(i, k, combo, seeds[i*orderings + k]) for i, combo in enumerate(combos) for k in range(orderings)]
+    design = DesignCache(data).encode(list(dict.fromkeys(sum(combos, []))))
+    job = partial(searchjob, design, response)
+    if workers > 1:
+        with Pool(workers) as pool:
+            return pool.map(job, jobs)
+    return [job(j) for j in jobs]
+
+def bestcombos(records, orderings):
+    '''Index of the combination with the lowest AICc under each ordering'''
+    return [min((r for r in records if r['ordering'] == k), key=lambda r: r['aicc'])['combo'] for k in range(orderings)]
+
+def writetable(outfile, records):
+    '''Writes the search results, one row per selection'''
+    with open(outfile, 'w') as f:
+        f.write("combo\tordering\tfeatures\tAICc\trank\tR_sq\tmodel\n")
+        for r in records:
+            f.write("{:d}\t{:d}\t{:s}\t{:f}\t{:d}\t{:f}\t{:s}\n".format(r['combo'], r['ordering'], ' + '.join(r['features']),
+                r['aicc'], r['rank'], r['rsquared'], ' + '.join(termlabel(term) for term in r['terms'])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--system',
+            type    =   str,
+            default =   'bind',
+            choices =   sorted(systems),
+            help    =   "Which model-build setup to search, binding or folding")
+    parser.add_argument('--datfile',
+            type    =   str,
+            default =   None,
+            help    =   "Processed table, defaults to the system's table in data/processed")
+    parser.add_argument('--response',
+            type    =   str,
+            default =   'ep_abs',
+            help    =   "Dependent variable")
+    parser.add_argument('--orderings',
+            type    =   int,
+            default =   2,
+            help    =   "Random feature orderings to run every combination under")
+    parser.add_argument('--workers',
+            type    =   int,
+            default =   1,
+            help    =   "Number of processes to spread the selections over")
+    parser.add_argument('--seed',
+            type    =   int,
+            default =   None,
+            help    =   "Seed for the feature orderings, a fresh one is drawn and printed if not given")
+    parser.add_argument('--out',
+            type    =   str,
+            default =   'model_search.txt',
+            help    =   "Output table of every selection")
+    parser.add_argument('--bestout',
+            type    =   str,
+            default =   None,
+            help    =   "If given, writes the summary of the best model here")
+    parser.add_argument('--deltaout',
+            type    =   str,
+            default =   None,
+            help    =   "If given, writes the delta R-sq of every feature of the best model here")
+    args = parser.parse_args()
+    setup = systems[args.system]
+    combos = allcombos(setup['features'], setup['abstractions'])
+    data = readtable(args.datfile if args.datfile is not None else setup['datfile'], sorted(set(sum(combos, []))), args.response)
+    seed = np.random.SeedSequence(args.seed).entropy
+    print("Seed: {:d}".format(seed))
+    records = search(data, args.response, combos, orderings=args.orderings, workers=args.workers, seed=seed)
+    writetable(args.out, records)
+    winners = bestcombos(records, args.orderings)
+    if len(set(winners)) > 1:
+        print("ERROR: Mismatched models, best combinations per ordering: {}".format(winners))
+    best = min(records, key=lambda r: r['aicc'])
+    print("Best: combination {:d}, AICc {:f}, R_sq {:f}".format(best['combo'], best['aicc'], best['rsquared']))
+    print("{:s} ~ {:s}".format(args.response, ' + '.join(termlabel(term) for term in best['terms'])))
+    if args.bestout is not None:
+        with open(args.bestout, 'w') as f:
+            f.write(formatsummary(olssummary(data, args.response, best['terms'])) + '\n')
+    if args.deltaout is not None:
+        with open(args.deltaout, 'w') as f:
+            for name, delta in deltarsq(data, args.response, best['terms']).items():
+                f.write("{:s}: {:.15g}\n".format(name, delta))
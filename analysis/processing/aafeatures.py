@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+'''
+Amino acid attribute features of double mutants, the size_net, hp_ab* and charge_ab* columns of
+the processed tables, from the mutation strings (e.g. RA190A,EA231A) and the per-residue table in
+data/mappings/aaMapFinal.txt.
+
+Mutation strings are parsed in bulk into integer residue codes (letter - 'A'), attributes are
+looked up in arrays indexed by those codes and every abstraction is a lookup into a small label
+table indexed by the combined codes, so a whole dataset is done in a few array passes:
+
+    size_net    sum over both residues of |size(wt) - size(mut)|
+    hp_ab1      wild type and mutant hydrophobicity pairs, each in sorted order (HP;HH), 00 if equal
+    hp_ab2      hydrophobic residues of the wild type pair less those of the mutant pair
+    hp_ab3      1 if the number of hydrophobic residues changes (hp_ab1 isn't 00)
+    charge_ab1  wild type and mutant charge pairs in mutation order (+-;00)
+    charge_ab2  0A/0R if the pair gains or loses an attractive/repulsive charge pair, else 00
+    charge_ab3  1 if charge_ab2 isn't 00
+
+ss_ab2 and ss_ab3 follow from the wild type secondary structure pair (ss_ab1), which comes from
+the structure: ss_ab2 is the pair in sorted order, ss_ab3 is 1 if the two residues differ.
+'''
+
+#---imports---#
+
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import sys
+
+#---constants---#
+
+mapfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'mappings', 'aaMapFinal.txt')
+
+#Hydrophobicity pairs by number of H, charges by sign + 1 and charge pair classes (none, attractive, repulsive)
+hppairs = np.array(['PP', 'HP', 'HH'])
+charges = np.array(['-', '0', '+'])
+chargeclasses = np.array(['0', 'A', 'R'])
+
+#---functions---#
+
+def loadmap(mappingfile=mapfile):
+    '''
+    Attribute arrays indexed by residue code (letter - 'A'): charge (-1, 0, 1), hydrophobic
+    (1 for H) and size. Letters missing from the table get nan size and can be found with valid
+    '''
+    charge = np.zeros(26, dtype=np.int8)
+    hydrophobic = np.zeros(26, dtype=np.int8)
+    size = np.full(26, np.nan)
+    valid = np.zeros(26, dtype=bool)
+    with open(mappingfile, 'r') as f:
+        next(f)
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            code = ord(fields[0]) - ord('A')
+            charge[code] = {'+' : 1, '-' : -1}.get(fields[1], 0)
+            hydrophobic[code] = fields[2] == 'H'
+            size[code] = float(fields[3])
+            valid[code] = True
+    return {'charge' : charge, 'hydrophobic' : hydrophobic, 'size' : size, 'valid' : valid}
+
+def residuecodes(mutations):
+    '''
+    Wild type and mutant residue codes of double mutant strings, as two (n, 2) uint8 arrays.
+    The strings are joined into one byte buffer and the residues read off around the commas and
+    line ends: the wild type residue is the first letter of a mutation and the mutant the last
+    '''
+    buffer = np.frombuffer(('\n'.join(mutations) + '\n').encode('ascii'), dtype=np.uint8)
+    ends = np.flatnonzero(buffer == ord('\n'))
+    commas = np.flatnonzero(buffer == ord(','))
+    if len(commas) != len(ends):
+        raise ValueError("Mutations should be pairs, e.g. RA190A,EA231A")
+    starts = np.append(0, ends[:-1] + 1)
+    wt = np.stack([buffer[starts], buffer[commas + 1]], axis=1) - ord('A')
+    mut = np.stack([buffer[commas - 1], buffer[ends - 1]], axis=1) - ord('A')
+    return wt, mut
+
+def chargeclass(charge):
+    '''Class of a charge pair: 0 none, 1 attractive, 2 repulsive'''
+    product = charge[:,0].astype(int)*charge[:,1]
+    return np.where(product < 0, 1, np.where(product > 0, 2, 0))
+
+def chargelabels():
+    '''charge_ab1 labels indexed by the base 3 code of the four charges (wt1, wt2, mut1, mut2)'''
+    c = np.arange(81)
+    digits = [c//27, c//9 % 3, c//3 % 3, c % 3]
+    return np.char.add(np.char.add(np.char.add(np.char.add(charges[digits[0]], charges[digits[1]]), ';'), charges[digits[2]]), charges[digits[3]])
+
+def features(mutations, attributes=None):
+    '''Every attribute feature of the double mutant strings, as a DataFrame in the processed tables' column order'''
+    attributes = loadmap() if attributes is None else attributes
+    wt, mut = residuecodes(mutations)
+    if max(wt.max(), mut.max()) >= 26 or not (attributes['valid'][wt].all() and attributes['valid'][mut].all()):
+        raise ValueError("Residues missing from the attribute table")
+    hpwt, hpmut = attributes['hydrophobic'][wt], attributes['hydrophobic'][mut]
+    nwt, nmut = hpwt.sum(axis=1), hpmut.sum(axis=1)
+    hplabels = np.char.add(np.char.add(hppairs[:,None], ';'), hppairs[None,:])
+    hplabels[np.diag_indices(3)] = '00'
+    qwt, qmut = attributes['charge'][wt], attributes['charge'][mut]
+    digits = (qwt[:,0] + 1)*27 + (qwt[:,1] + 1)*9 + (qmut[:,0] + 1)*3 + (qmut[:,1] + 1)
+    classwt, classmut = chargeclass(qwt), chargeclass(qmut)
+    change = np.where(classwt != classmut, np.where(classwt > 0, classwt, classmut), 0)
+    return pd.DataFrame({
+        'size_net' : np.abs(attributes['size'][wt] - attributes['size'][mut]).sum(axis=1),
+        'hp_ab1' : hplabels[nwt, nmut],
+        'hp_ab2' : nwt.astype(int) - nmut,
+        'hp_ab3' : (nwt != nmut).astype(int),
+        'charge_ab1' : chargelabels()[digits],
+        'charge_ab2' : np.char.add('0', chargeclasses[change]),
+        'charge_ab3' : (change > 0).astype(int)})
+
+def ssabstractions(ss_ab1):
+    '''ss_ab2 and ss_ab3 from the wild type secondary structure pairs (ss_ab1), e.g. LH'''
+    letters = np.asarray(ss_ab1, dtype='U2').view('U1').reshape(-1, 2)
+    first, second = letters[:,0], letters[:,1]
+    ordered = np.where(first <= second, np.char.add(first, second), np.char.add(second, first))
+    return pd.DataFrame({'ss_ab2' : ordered, 'ss_ab3' : (first != second).astype(int)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datfile',
+            type    =   str,
+            help    =   "Tab separated table with a mutations column, e.g. the output of skempiprocess.py")
+    parser.add_argument('--out',
+            type    =   str,
+            help    =   "Output table, the input with the feature columns added (or replaced)")
+    parser.add_argument('--mapping',
+            type    =   str,
+            default =   mapfile,
+            help    =   "Amino acid attribute table")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    data = pd.read_csv(args.datfile, sep='\t')
+    made = features(data['mutations'], loadmap(args.mapping))
+    if 'ss_ab1' in data:
+        made = pd.concat([made, ssabstractions(data['ss_ab1'])], axis=1)
+    for column in made:
+        data[column] = made[column].to_numpy()
+    data.to_csv(args.out, sep='\t', index=False)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+'''
+Epistasis rows from the raw SKEMPI v2.0 table (data/raw/skempi_v2.csv).
+
+The raw file is streamed a line at a time. Every measurement with a parsed mutant and wild type
+affinity and a temperature gives ddG = RT ln(Kd_mut/Kd_wt). Single mutants are indexed by
+(complex, mutation) and double mutants by (complex, mutations), averaging repeated measurements.
+Every double is then joined to its two singles by lookups in the single index, and
+epistasis = ddG12 - (ddG1 + ddG2). The complex key is the #Pdb entry with its chains, so
+measurements of different interfaces of one structure aren't mixed; the cplx column written out
+is the lower case PDB code, as in data/processed.
+
+Only the columns up to ep_abs are made here; the structural features of the processed tables
+(separation, sasa, ss, interface side) need the structures themselves.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import csv
+import re
+import sys
+
+#---constants---#
+
+#Gas constant in kcal/(mol K)
+gasconstant = 8.314/4184
+
+columns = ['cplx', 'mutations', 'ddG1', 'ddG2', 'ddG1+ddG2', 'ddG12', 'epistasis', 'ep_abs']
+
+#---functions---#
+
+def temperature(text):
+    '''Temperature in K from SKEMPI's field, e.g. 298(assumed), None if missing'''
+    match = re.match(r'\s*(\d+(?:\.\d+)?)', text)
+    return float(match.group(1)) if match else None
+
+def skempirecords(rawfile):
+    '''
+    Streams the measurements of a raw SKEMPI file as (complex, mutations, ddG) tuples, skipping the
+    ones without parsed affinities or a temperature
+    '''
+    with open(rawfile, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter=';')
+        header = next(reader)
+        pdb, mutations = header.index('#Pdb'), header.index('Mutation(s)_PDB')
+        mut, wt, temp = header.index('Affinity_mut_parsed'), header.index('Affinity_wt_parsed'), header.index('Temperature')
+        for row in reader:
+            kelvin = temperature(row[temp])
+            try:
+                ratio = float(row[mut])/float(row[wt])
+            except (ValueError, ZeroDivisionError):
+                continue
+            if kelvin is None or not ratio > 0:
+                continue
+            yield row[pdb], row[mutations], gasconstant*kelvin*np.log(ratio)
+
+def indexrecords(records):
+    '''
+    Mean ddG of every single and double mutant, as two dicts keyed by (complex, mutation) and
+    (complex, mutations). Higher order mutants are left out
+    '''
+    sums = ({}, {})
+    for cplx, mutations, ddg in records:
+        order = mutations.count(',')
+        if order > 1:
+            continue
+        total, count = sums[order].get((cplx, mutations), (0.0, 0))
+        sums[order][(cplx, mutations)] = (total + ddg, count + 1)
+    return [{key : total/count for key, (total, count) in index.items()} for index in sums]
+
+def epistasisrows(singles, doubles):
+    '''Joins every double to its two singles, in the order the doubles first appear. Doubles missing a single are dropped'''
+    rows = []
+    for (cplx, mutations), ddg12 in doubles.items():
+        first, second = mutations.split(',')
+        if (cplx, first) in singles and (cplx, second) in singles:
+            ddg1, ddg2 = singles[(cplx, first)], singles[(cplx, second)]
+            epistasis = ddg12 - (ddg1 + ddg2)
+            rows.append((cplx[:4].lower(), mutations, ddg1, ddg2, ddg1 + ddg2, ddg12, epistasis, abs(epistasis)))
+    return rows
+
+def writerows(outfile, rows):
+    '''Writes the rows as a tab separated table with the processed tables' column names'''
+    with open(outfile, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for row in rows:
+            f.write("{:s}\t{:s}\t{:g}\t{:g}\t{:g}\t{:g}\t{:g}\t{:g}\n".format(*row))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw',
+            type    =   str,
+            help    =   "Raw SKEMPI table, semicolon delimited (data/raw/skempi_v2.csv)")
+    parser.add_argument('--out',
+            type    =   str,
+            default =   'skempi_bind_epistasis.txt',
+            help    =   "Output table of double mutants with their ddG and epistasis")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    singles, doubles = indexrecords(skempirecords(args.raw))
+    rows = epistasisrows(singles, doubles)
+    writerows(args.out, rows)
+    print("{:d} singles, {:d} doubles, {:d} epistasis rows".format(len(singles), len(doubles), len(rows)))
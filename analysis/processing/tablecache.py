@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+'''
+Columnar binary cache of the processed tables (data/processed/*.txt), shared by the analysis and
+figure scripts.
+
+The first load of a table parses the text once and writes one .npy file per column to a cache
+directory next to it (.<table>.cache). Numeric columns are stored as they are and memory-mapped
+on later loads; text columns are dictionary encoded, stored as integer codes with their levels in
+the cache's meta.json. The cache records the size and modification time of the text it came from
+and is rebuilt when the source changes. Builds go to a private temporary directory that is renamed
+into place, so processes loading a new table at once never see each other's half-written files; a
+builder that finds a current cache already published uses it, and readers whose cache was replaced
+under them reopen it. pandas is only imported to build a cache or make a DataFrame, so reading
+columns of a cached table costs numpy alone.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+#---constants---#
+
+#Times a cache is reopened when another process replaces it mid-read or mid-publish
+retries = 5
+
+#---functions---#
+
+def cachedir(datafile):
+    '''Cache directory of a table, next to it'''
+    head, tail = os.path.split(os.path.abspath(datafile))
+    return os.path.join(head, '.' + os.path.splitext(tail)[0] + '.cache')
+
+def stamp(datafile):
+    '''Size and modification time of a table, what its cache is checked against'''
+    stat = os.stat(datafile)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def readmeta(directory):
+    '''The meta.json of a cache, None if missing or unreadable'''
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def codetype(nlevels):
+    '''Smallest signed integer type for the codes of nlevels levels, -1 marking missing values'''
+    return np.int8 if nlevels < 2**7 else np.int16 if nlevels < 2**15 else np.int32
+
+def publish(tmp, directory, meta):
+    '''
+    Moves a cache built in tmp with meta into place. A stale live cache is moved aside rather
+    than deleted first, and if another process has published a cache of the same source that one
+    is kept and tmp dropped. Returns the meta of the cache in place
+    '''
+    head = os.path.dirname(directory)
+    for attempt in range(retries):
+        try:
+            os.rename(tmp, directory)
+            return meta
+        except OSError:
+            if not os.path.isdir(tmp):
+                raise
+        current = readmeta(directory)
+        if current is not None and current['source'] == meta['source']:
+            return current
+        old = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.old.', dir=head)
+        try:
+            os.rename(directory, old)
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(old, ignore_errors=True)
+    raise OSError("Could not publish the cache {:s}".format(directory))
+
+def buildcache(datafile, separator='\t'):
+    '''
+    Parses a table and writes its cache, columns to a temporary directory of this process that
+    is then published in place of the old cache. Returns the meta of the cache in place
+    '''
+    import pandas as pd
+    directory = cachedir(datafile)
+    source = stamp(datafile)
+    data = pd.read_csv(datafile, sep=separator)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.tmp.', dir=os.path.dirname(directory))
+    try:
+        meta = {'source' : source, 'rows' : len(data), 'columns' : []}
+        for i, name in enumerate(data.columns):
+            column = {'name' : name, 'file' : '{:d}.npy'.format(i)}
+            if pd.api.types.is_numeric_dtype(data[name]) and not pd.api.types.is_bool_dtype(data[name]):
+                np.save(os.path.join(tmp, column['file']), data[name].to_numpy())
+            else:
+                codes, levels = pd.factorize(data[name], sort=True)
+                column['levels'] = [str(level) for level in levels]
+                np.save(os.path.join(tmp, column['file']), codes.astype(codetype(len(levels))))
+            meta['columns'].append(column)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        return publish(tmp, directory, meta)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def opencache(datafile):
+    '''Cache directory and meta of a table, building the cache if it is missing or stale'''
+    directory = cachedir(datafile)
+    meta = readmeta(directory)
+    if meta is None or meta['source'] != stamp(datafile):
+        meta = buildcache(datafile)
+    return directory, meta
+
+def decode(codes, levels):
+    '''Values of dictionary encoded codes, missing (-1) as nan'''
+    values = np.append(np.array(levels, dtype=object), np.nan)
+    return values[np.where(codes < 0, len(levels), codes)]
+
+def loadcolumns(datafile, columns):
+    '''
+    Chosen columns of a table as arrays, numeric ones memory-mapped from the cache and text ones
+    decoded from their codes. The cache is reopened if another process replaces it meanwhile
+    '''
+    for attempt in range(retries):
+        directory, meta = opencache(datafile)
+        byname = {column['name'] : column for column in meta['columns']}
+        missing = [name for name in columns if name not in byname]
+        if missing:
+            raise KeyError("Columns not in {:s}: {}".format(datafile, missing))
+        try:
+            arrays = []
+            for name in columns:
+                column = byname[name]
+                array = np.load(os.path.join(directory, column['file']), mmap_mode='r')
+                arrays.append(decode(array, column['levels']) if 'levels' in column else array)
+            return arrays
+        except FileNotFoundError:
+            if attempt == retries - 1:
+                raise
+
+def loadtable(datafile, columns=None):
+    '''A table (or some of its columns) as a DataFrame, read through its cache'''
+    import pandas as pd
+    directory, meta = opencache(datafile)
+    columns = [column['name'] for column in meta['columns']] if columns is None else list(columns)
+    return pd.DataFrame(dict(zip(columns, loadcolumns(datafile, columns))), columns=columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tables',
+            nargs   =   '+',
+            help    =   "Tab separated tables to build or refresh the caches of")
+    parser.add_argument('--clear',
+            action  =   'store_true',
+            help    =   "Remove the caches instead")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    for table in args.tables:
+        if args.clear:
+            shutil.rmtree(cachedir(table), ignore_errors=True)
+            continue
+        directory, meta = opencache(table)
+        print("{:s}: {:d} rows, {:d} columns in {:s}".format(table, meta['rows'], len(meta['columns']), directory))
@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+
+'''
+Stepwise AICc model selection in the manner of stepAICc.r, for gaussian linear models of the
+processed tables. Starts from the (features)^2 model (all main effects and pairwise interactions)
+and adds or drops one term per step, respecting marginality, until no move lowers AICc.
+
+Candidate moves are scored from one QR factorization of the current model instead of a refit each:
+dropping a term is a small least-squares problem in the R factor, adding one only orthogonalizes
+the new columns against Q. Aliased columns are detected as lm does, by limited pivoting.
+'''
+
+#---imports---#
+
+import numpy as np
+import pandas as pd
+import argparse
+import os
+import sys
+from functools import partial
+from scipy.stats import t as tdist
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'processing'))
+from tablecache import loadtable
+
+#---constants---#
+
+#Relative tolerance for aliased (linearly dependent) columns, lm's default
+qrtol = 1e-7
+
+#---functions---#
+
+def readtable(datafile, variables, response):
+    '''Reads a processed table through its column cache, keeping the rows that have the response and all variables'''
+    data = loadtable(datafile)
+    return data.dropna(subset=list(variables) + [response]).reset_index(drop=True)
+
+def expandformula(variables):
+    '''Terms of (variables)^2 in R's order: main effects, then the pairwise interactions'''
+    variables = list(variables)
+    return [(v,) for v in variables] + [(u, v) for i, u in enumerate(variables) for v in variables[i+1:]]
+
+def termlabel(term):
+    '''R's label for a term, e.g. separation:cplx_type'''
+    return ':'.join(term)
+
+class DesignCache:
+    '''
+    Model matrix blocks of one dataset, each variable and each pairwise interaction encoded once
+    and shared by every formula, feature ordering and fold fit on it. Numeric variables enter as
+    they are and categorical ones as treatment contrasts against their first level, stored as
+    uint8 indicators; an interaction block is the product of its variables' blocks, stored once
+    for both orders of the pair (so indicator products stay uint8).
+    subset(rows) gives the cache of some rows, sliced from these blocks so the contrasts stay those
+    of the whole dataset
+    '''
+    def __init__(self, data, parent=None, rows=None):
+        self.data = data
+        self.n = len(data)
+        self.parent = parent
+        self.rows = rows
+        self.variables = {}
+        self.pairs = {}
+
+    def subset(self, rows):
+        '''Cache for the given rows of the dataset'''
+        return DesignCache(self.data.iloc[rows].reset_index(drop=True), parent=self, rows=np.asarray(rows))
+
+    def variable(self, name):
+        '''Column names and compact block of a variable'''
+        if name not in self.variables:
+            if self.parent is not None:
+                names, block = self.parent.variable(name)
+                self.variables[name] = (names, block[self.rows])
+            elif pd.api.types.is_numeric_dtype(self.data[name]):
+                self.variables[name] = ([name], self.data[name].to_numpy(dtype=float)[:,None])
+            else:
+                values = self.data[name].to_numpy()
+                levels = sorted(set(values))[1:]
+                self.variables[name] = ([name + str(level) for level in levels],
+                                        (values[:,None] == np.array(levels, dtype=object)[None,:]).astype(np.uint8))
+        return self.variables[name]
+
+    def pair(self, u, v):
+        '''Column names and compact block of u:v, u varying fastest as in model.matrix'''
+        if (u, v) not in self.pairs and (v, u) not in self.pairs:
+            if self.parent is not None:
+                key, block = self.parent.pairblock(u, v)
+                self.pairs[key] = block[self.rows]
+            else:
+                self.pairs[(u, v)] = self.variable(v)[1][:,:,None] * self.variable(u)[1][:,None,:]
+        unames, vnames = self.variable(u)[0], self.variable(v)[0]
+        names = [uname + ':' + vname for vname in vnames for uname in unames]
+        if (u, v) in self.pairs:
+            return names, self.pairs[(u, v)].reshape(self.n, -1)
+        return names, self.pairs[(v, u)].transpose(0, 2, 1).reshape(self.n, -1)
+
+    def pairblock(self, u, v):
+        '''
+        The stored product of a pair as (n, columns of the second variable, columns of the first)
+        and the order it was stored in
+        '''
+        self.pair(u, v)
+        key = (u, v) if (u, v) in self.pairs else (v, u)
+        return key, self.pairs[key]
+
+    def encode(self, variables):
+        '''Encodes every variable and pairwise interaction of variables up front, e.g. before the cache is sent to workers'''
+        for term in expandformula(variables):
+            self[term]
+        return self
+
+    def __getitem__(self, term):
+        '''Column names and float64 model matrix block of a term'''
+        names, block = self.variable(term[0]) if len(term) == 1 else self.pair(*term)
+        return names, block.astype(float)
+
+def orthogonalize(Q, X, norms, tol=qrtol):
+    '''
+    Sequentially orthogonalizes the columns of X against Q and each other (twice, for stability).
+    A column whose remainder is below tol times its norm is aliased and left out, like the
+    limited pivoting of lm. Returns the new orthonormal columns and the mask of kept columns
+    '''
+    X = X - Q @ (Q.T @ X)
+    X = X - Q @ (Q.T @ X)
+    basis = np.zeros((X.shape[0], X.shape[1]))
+    kept = np.zeros(X.shape[1], dtype=bool)
+    k = 0
+    for j in range(X.shape[1]):
+        v = X[:,j]
+        for rep in range(2):
+            v = v - basis[:,:k] @ (basis[:,:k].T @ v)
+        size = np.sqrt(v @ v)
+        if size > tol*norms[j]:
+            basis[:,k] = v/size
+            kept[j] = True
+            k += 1
+    return basis[:,:k], kept
+
+def gramfactor(G, norms, tol=qrtol):
+    '''
+    The counterpart of orthogonalize for a Gram matrix: G holds the cross products of the columns
+    and, last, the response. Columns are factored in order with the same aliasing test, on the
+    cross products scaled by the column norms. Returns Q'X for all columns and the response (one
+    row per kept column) and the mask of kept columns
+    '''
+    scale = np.append(norms, np.sqrt(G[-1,-1]))
+    scale[scale == 0] = 1
+    G = G/np.outer(scale, scale)
+    p = len(norms)
+    R = np.zeros((p, p + 1))
+    kept = np.zeros(p, dtype=bool)
+    k = 0
+    for j in range(p):
+        size = G[j,j] - R[:k,j] @ R[:k,j]
+        if norms[j] > 0 and size > tol**2:
+            R[k,j] = np.sqrt(size)
+            R[k,j+1:] = (G[j,j+1:] - R[:k,j] @ R[:k,j+1:])/R[k,j]
+            kept[j] = True
+            k += 1
+    return R[:k]*scale[None,:], kept
+
+def aicc(rss, n, rank):
+    '''AICc of a gaussian linear model, with the residual variance counted as a parameter as in extractAICc'''
+    k = rank + 1
+    return n*(np.log(2*np.pi*rss/n) + 1) + 2*k + 2*k*(k + 1)/(n - k - 1)
+
+class ModelFit:
+    '''
+    QR factorization of a model made of the intercept and the blocks of its terms (taken from a
+    DesignCache), and the scores of all single-term moves from it
+    '''
+    def __init__(self, design, y, terms):
+        self.design = design
+        self.y = y
+        self.n = len(y)
+        self.terms = list(terms)
+        blocks = [design[term][1] for term in self.terms]
+        self.X = np.column_stack([np.ones(self.n)] + blocks)
+        self.owner = np.concatenate([[-1]] + [np.full(block.shape[1], i) for i, block in enumerate(blocks)])
+        self.norms = np.sqrt(np.sum(self.X**2, axis=0))
+        self.Q, self.kept = orthogonalize(np.zeros((self.n, 0)), self.X, self.norms)
+        self.R = self.Q.T @ self.X
+        self.z = self.Q.T @ y
+        self.residual = y - self.Q @ self.z
+        self.rss = self.residual @ self.residual
+        self.rank = self.Q.shape[1]
+        self.aicc = aicc(self.rss, self.n, self.rank)
+
+    def drop(self, *terms):
+        '''
+        RSS and rank without the given terms, from the R factor alone. Columns before the first
+        dropped one keep their part of the factorization; the independent columns after it are
+        refactored in the rows below that part, and columns that were aliased are checked again
+        since they may have depended on a dropped term
+        '''
+        mine = np.isin(self.owner, [self.terms.index(term) for term in terms])
+        first = np.argmax(mine)
+        k0 = np.sum(self.kept[:first])
+        later = ~mine & (np.arange(len(mine)) > first)
+        z = self.z[k0:]
+        Q1 = np.linalg.qr(self.R[k0:, later & self.kept])[0]
+        U, kept = orthogonalize(Q1, self.R[k0:, later & ~self.kept], self.norms[later & ~self.kept])
+        fitted = np.sum((Q1.T @ z)**2) + np.sum((U.T @ z)**2)
+        return self.rss + z @ z - fitted, k0 + Q1.shape[1] + U.shape[1]
+
+    def add(self, term):
+        '''RSS and rank with term added, orthogonalizing only its columns'''
+        C = self.design[term][1]
+        U, kept = orthogonalize(self.Q, C, np.sqrt(np.sum(C**2, axis=0)))
+        return self.rss - np.sum((U.T @ self.residual)**2), self.rank + U.shape[1]
+
+class CrossProducts:
+    '''
+    Sufficient statistics of a dataset: the cross products of the intercept, the blocks of every
+    term of (variables)^2 and the response. Any model made of those terms can be fit from them,
+    and downdate(rows) gives the statistics without some rows by subtracting just their part, so
+    folds of a validation reuse the full-data products instead of rebuilding them
+    '''
+    def __init__(self, design, response, variables, gram=None, n=None):
+        self.design = design
+        self.response = response
+        self.variables = list(variables)
+        self.n = design.n if n is None else n
+        self.offsets = {}
+        offset = 1
+        for term in expandformula(self.variables):
+            self.offsets[frozenset(term)] = (term, offset)
+            offset += len(design[term][0])
+        self.gram = self.products(np.arange(design.n)) if gram is None else gram
+
+    def products(self, rows):
+        '''Cross products of the given rows'''
+        X = np.column_stack([np.ones(len(rows))] + [self.design[term][1][rows] for term, offset in self.offsets.values()] +
+                            [self.design.data[self.response].to_numpy(dtype=float)[rows]])
+        return X.T @ X
+
+    def downdate(self, rows):
+        '''Cross products with the given rows left out'''
+        return CrossProducts(self.design, self.response, self.variables, gram=self.gram - self.products(rows), n=self.n - len(rows))
+
+    def columns(self, term):
+        '''Indices of a term's columns, in the order its DesignCache block has them'''
+        stored, offset = self.offsets[frozenset(term)]
+        if term == stored or len(term) == 1:
+            return offset + np.arange(len(self.design[term][0]))
+        nu, nv = len(self.design.variable(term[0])[0]), len(self.design.variable(term[1])[0])
+        return offset + (np.arange(nu)[None,:]*nv + np.arange(nv)[:,None]).ravel()
+
+    def tss(self):
+        '''Total sum of squares of the response'''
+        return self.gram[-1,-1] - self.gram[0,-1]**2/self.n
+
+class GramFit(ModelFit):
+    '''
+    ModelFit from CrossProducts rather than the model matrix: the R factor and Q'y come from a
+    Cholesky factorization of the model's cross products, so a fit costs nothing per row. Drops
+    are scored as in ModelFit; adds use the cross products of the new columns
+    '''
+    def __init__(self, cross, terms):
+        self.cross = cross
+        self.n = cross.n
+        self.terms = list(terms)
+        blocks = [cross.columns(term) for term in self.terms]
+        self.index = np.concatenate([[0]] + blocks).astype(int)
+        self.owner = np.concatenate([[-1]] + [np.full(len(block), i) for i, block in enumerate(blocks)])
+        G = cross.gram[np.ix_(np.append(self.index, -1), np.append(self.index, -1))]
+        self.norms = np.sqrt(np.diag(G)[:-1])
+        R, self.kept = gramfactor(G, self.norms)
+        self.R, self.z = R[:,:-1], R[:,-1]
+        self.rss = G[-1,-1] - self.z @ self.z
+        self.rank = len(self.z)
+        self.aicc = aicc(self.rss, self.n, self.rank)
+
+    def add(self, term):
+        '''RSS and rank with term added, from the cross products of its columns with the model'''
+        columns = self.cross.columns(term)
+        gram = self.cross.gram
+        W = np.linalg.solve(np.triu(self.R[:,self.kept]).T, gram[np.ix_(self.index[self.kept], columns)])
+        S = gram[np.ix_(columns, columns)] - W.T @ W
+        w = gram[columns,-1] - W.T @ self.z
+        G = np.block([[S, w[:,None]], [w[None,:], np.array([[self.rss]])]])
+        U, kept = gramfactor(G, np.sqrt(np.diag(gram)[columns]))
+        return self.rss - U[:,-1] @ U[:,-1], self.rank + U.shape[0]
+
+def contains(term, other):
+    '''Whether term is marginal to (a lower order part of) other'''
+    return term != other and set(term) <= set(other)
+
+def dropscope(terms):
+    '''Terms that can be dropped: those no other term in the model contains'''
+    return [term for term in terms if not any(contains(term, other) for other in terms)]
+
+def addscope(terms, upper):
+    '''Terms of upper not in the model whose lower order parts all are'''
+    return [term for term in upper if term not in terms and
+            all(other in terms for other in upper if contains(other, term))]
+
+def addterm(terms, term):
+    '''Adds a term after the last one of the same or lower order, where update() puts it'''
+    position = max([i + 1 for i, other in enumerate(terms) if len(other) <= len(term)], default=0)
+    return terms[:position] + [term] + terms[position:]
+
+def stepaicc(data, response, variables, steps=100000, trace=False, design=None, cross=None):
+    '''
+    Stepwise AICc selection in both directions from the (variables)^2 model, following stepAICc:
+    a drop that leaves the rank unchanged is made at once, otherwise the single add or drop with
+    the lowest AICc is made as long as it beats the current model. design is the DesignCache of
+    data to take the model matrix blocks from, a new one is made if not given. If cross is given,
+    the fits are made from those CrossProducts instead and data isn't used.
+    Returns the selected terms, their AICc, RSS, rank, R-sq and the path of changes
+    '''
+    upper = expandformula(variables)
+    if cross is not None:
+        model = partial(GramFit, cross)
+        tss = cross.tss()
+    else:
+        design = DesignCache(data) if design is None else design
+        y = data[response].to_numpy(dtype=float)
+        model = partial(ModelFit, design, y)
+        tss = np.sum((y - y.mean())**2)
+    fit = model(upper)
+    path = [('', fit.aicc)]
+    if trace:
+        print("Start:  AICc={:.2f}".format(fit.aicc))
+    while steps > 0:
+        steps -= 1
+        current = fit.aicc
+        change = None
+        candidates = []
+        for term in dropscope(fit.terms):
+            rss, rank = fit.drop(term)
+            score = aicc(rss, fit.n, rank)
+            if rank == fit.rank:
+                if abs(score - current) <= 0.01:
+                    change = ('-', term)
+                continue
+            candidates.append((score, '-', term))
+        if change is None:
+            for term in addscope(fit.terms, upper):
+                rss, rank = fit.add(term)
+                if rank != fit.rank:
+                    candidates.append((aicc(rss, fit.n, rank), '+', term))
+            if not candidates:
+                break
+            best = min(range(len(candidates)), key=lambda i: candidates[i][0])
+            if candidates[best][0] >= current:
+                break
+            change = candidates[best][1:]
+        sign, term = change
+        fit = model([other for other in fit.terms if other != term] if sign == '-' else addterm(fit.terms, term))
+        if trace:
+            print("Step:  {:s} {:s}  AICc={:.2f}".format(sign, termlabel(term), fit.aicc))
+        if fit.aicc >= current + 1e-7:
+            break
+        path.append((sign + ' ' + termlabel(term), fit.aicc))
+    return {'terms' : fit.terms, 'aicc' : fit.aicc, 'rss' : fit.rss, 'rank' : fit.rank, 'n' : fit.n,
+            'rsquared' : 1 - fit.rss/tss, 'path' : path}
+
+def deltarsq(data, response, terms, design=None, cross=None):
+    '''
+    R-sq lost by leaving each variable out of a model, like delta_r_sq of the model-build scripts:
+    for every main effect, the model without it and every interaction containing it. All drops are
+    scored from one factorization of the full model (from cross if given, else from the
+    DesignCache). Returns {'Full model' : R-sq, variable : delta R-sq, ...} in the order of the terms
+    '''
+    if cross is not None:
+        fit = GramFit(cross, terms)
+        tss = cross.tss()
+    else:
+        design = DesignCache(data) if design is None else design
+        y = data[response].to_numpy(dtype=float)
+        fit = ModelFit(design, y, terms)
+        tss = np.sum((y - y.mean())**2)
+    delta = {'Full model' : 1 - fit.rss/tss}
+    for term in terms:
+        if len(term) == 1:
+            rss, rank = fit.drop(*[other for other in terms if term[0] in other])
+            delta[term[0]] = (rss - fit.rss)/tss
+    return delta
+
+def olssummary(data, response, terms, design=None):
+    '''
+    Least-squares fit of a model given by its terms, like summary(lm(...)): coefficient names,
+    estimates, standard errors, t values and p values (nan for aliased columns), the residual
+    standard error and degrees of freedom, and R-sq
+    '''
+    design = DesignCache(data) if design is None else design
+    y = data[response].to_numpy(dtype=float)
+    fit = ModelFit(design, y, terms)
+    names = ['(Intercept)'] + [name for term in terms for name in design[term][0]]
+    Rk = np.triu(fit.R[:,fit.kept])
+    estimate = np.full(len(names), np.nan)
+    stderr = np.full(len(names), np.nan)
+    estimate[fit.kept] = np.linalg.solve(Rk, fit.z)
+    df = fit.n - fit.rank
+    sigma = np.sqrt(fit.rss/df)
+    Rinv = np.linalg.inv(Rk)
+    stderr[fit.kept] = sigma*np.sqrt(np.sum(Rinv**2, axis=1))
+    tvalue = estimate/stderr
+    return {'names' : names, 'estimate' : estimate, 'stderr' : stderr, 'tvalue' : tvalue,
+            'pvalue' : 2*tdist.sf(np.abs(tvalue), df), 'sigma' : sigma, 'df' : df,
+            'rsquared' : 1 - fit.rss/np.sum((y - y.mean())**2)}
+
+def formatsummary(summary):
+    '''Text coefficient table of an olssummary, laid out like R's'''
+    width = max(len(name) for name in summary['names'])
+    lines = ["{:{w}s} {:>11s} {:>11s} {:>8s} {:>10s}".format('', 'Estimate', 'Std. Error', 't value', 'Pr(>|t|)', w=width)]
+    for row in zip(summary['names'], summary['estimate'], summary['stderr'], summary['tvalue'], summary['pvalue']):
+        if np.isnan(row[1]):
+            lines.append("{:{w}s} {:>11s} {:>11s} {:>8s} {:>10s}".format(row[0], 'NA', 'NA', 'NA', 'NA', w=width))
+        else:
+            lines.append("{:{w}s} {:11.7f} {:11.7f} {:8.3f} {:10.3g}".format(*row, w=width))
+    lines.append("")
+    lines.append("Residual standard error: {:.4g} on {:d} degrees of freedom".format(summary['sigma'], summary['df']))
+    lines.append("Multiple R-squared:  {:.4g}".format(summary['rsquared']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datfile',
+            type    =   str,
+            help    =   "Processed table to select a model for")
+    parser.add_argument('--features',
+            type    =   str,
+            help    =   "Comma separated features, the start model is (features)^2")
+    parser.add_argument('--response',
+            type    =   str,
+            default =   'ep_abs',
+            help    =   "Dependent variable")
+    parser.add_argument('--trace',
+            action  =   'store_true',
+            help    =   "Print every step")
+    parser.add_argument('--out',
+            type    =   str,
+            default =   None,
+            help    =   "If given, writes the summary of the selected model here")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    features = args.features.split(',')
+    data = readtable(args.datfile, features, args.response)
+    result = stepaicc(data, args.response, features, trace=args.trace)
+    print("Selected: {:s} ~ {:s}".format(args.response, ' + '.join(termlabel(term) for term in result['terms'])))
+    print("AICc: {:.4f}".format(result['aicc']))
+    text = formatsummary(olssummary(data, args.response, result['terms']))
+    print(text)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+'''
+Leave-systems-out validation of the model search, in the manner of
+Epistasis_sta{s,ts}_final_*_validation.R.
+
+Every run leaves out a share of the systems (unique values of the group column, cplx), runs the
+abstraction search of modelsearch.py on the rest and records the best model. The left out systems
+of a run and its feature orderings come from a seed spawned for that run, so the runs don't depend
+on how they are spread over the worker processes. The folds are fit from the full-data cross
+products (stepaicc.CrossProducts) downdated by the left out rows. The runs are written as JSON
+lines, one record per run, as they finish.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import json
+import os
+import sys
+from functools import partial
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stepaicc'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'modelbuild'))
+from stepaicc import CrossProducts, DesignCache, readtable, stepaicc, termlabel, olssummary, deltarsq
+from modelsearch import systems, allcombos
+
+#---functions---#
+
+def groupfolds(groups, runs, fraction=0.1, seed=None):
+    '''
+    The (run, left out groups, seed) of every run. round(fraction) of the unique groups, in order
+    of appearance as R's unique gives them, are drawn without replacement from each run's seed
+    '''
+    unique = list(dict.fromkeys(groups))
+    number = int(round(fraction*len(unique)))
+    folds = []
+    for run, runseed in enumerate(np.random.SeedSequence(seed).spawn(runs)):
+        rng = np.random.default_rng(runseed)
+        folds.append((run, [unique[i] for i in rng.choice(len(unique), number, replace=False)], runseed))
+    return folds
+
+def validationrun(design, cross, response, group, combos, fold):
+    '''
+    One validation run: the search over combos on the data without the fold's groups, each
+    combination under one random ordering, and the summary and delta R-sq ranking of the best
+    selected model. Returns the run record
+    '''
+    run, removed, seed = fold
+    rng = np.random.default_rng(seed)
+    left = np.flatnonzero(design.data[group].isin(removed).to_numpy())
+    rows = np.flatnonzero(~design.data[group].isin(removed).to_numpy())
+    foldcross = cross.downdate(left)
+    best = None
+    for i, combo in enumerate(combos):
+        order = list(rng.permutation(combo))
+        result = stepaicc(None, response, order, cross=foldcross)
+        if best is None or result['aicc'] < best['aicc']:
+            best = dict(result, combo=i, features=order)
+    kept = design.subset(rows)
+    summary = olssummary(kept.data, response, best['terms'], design=kept)
+    return {'run' : run, 'removed' : removed, 'length' : len(rows), 'combo' : best['combo'], 'features' : best['features'],
+            'model' : [termlabel(term) for term in best['terms']], 'aicc' : best['aicc'], 'rsquared' : summary['rsquared'],
+            'rsq' : deltarsq(None, response, best['terms'], cross=foldcross),
+            'coefficients' : {name : row for name, *row in zip(summary['names'], summary['estimate'], summary['stderr'],
+                                                               summary['tvalue'], summary['pvalue'])}}
+
+def validate(data, response, combos, runs=100, fraction=0.1, group='cplx', workers=1, seed=None):
+    '''
+    Generator over the records of runs validation runs, in run order, spread over workers
+    processes. The design blocks and cross products of every feature and interaction are made once
+    here and shared by all runs
+    '''
+    variables = list(dict.fromkeys(sum(combos, [])))
+    design = DesignCache(data).encode(variables)
+    cross = CrossProducts(design, response, variables)
+    folds = groupfolds(data[group].tolist(), runs, fraction, seed)
+    job = partial(validationrun, design, cross, response, group, combos)
+    if workers > 1:
+        with Pool(workers) as pool:
+            yield from pool.imap(job, folds)
+    else:
+        yield from map(job, folds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--system',
+            type    =   str,
+            default =   'bind',
+            choices =   sorted(systems),
+            help    =   "Which model-build setup to validate, binding or folding")
+    parser.add_argument('--datfile',
+            type    =   str,
+            default =   None,
+            help    =   "Processed table, defaults to the system's table in data/processed")
+    parser.add_argument('--response',
+            type    =   str,
+            default =   'ep_abs',
+            help    =   "Dependent variable")
+    parser.add_argument('--runs',
+            type    =   int,
+            default =   100,
+            help    =   "Number of validation runs")
+    parser.add_argument('--fraction',
+            type    =   float,
+            default =   0.1,
+            help    =   "Share of the systems left out of every run")
+    parser.add_argument('--group',
+            type    =   str,
+            default =   'cplx',
+            help    =   "Column naming the system of every row")
+    parser.add_argument('--workers',
+            type    =   int,
+            default =   1,
+            help    =   "Number of processes to spread the runs over")
+    parser.add_argument('--seed',
+            type    =   int,
+            default =   None,
+            help    =   "Seed for the left out systems and orderings, a fresh one is drawn and printed if not given")
+    parser.add_argument('--out',
+            type    =   str,
+            default =   None,
+            help    =   "Output file, one JSON record per run, defaults to leave_out_{system}.jsonl")
+    args = parser.parse_args()
+    setup = systems[args.system]
+    combos = allcombos(setup['features'], setup['abstractions'])
+    data = readtable(args.datfile if args.datfile is not None else setup['datfile'], sorted(set(sum(combos, []))), args.response)
+    seed = np.random.SeedSequence(args.seed).entropy
+    print("Seed: {:d}".format(seed))
+    outfile = args.out if args.out is not None else 'leave_out_{:s}.jsonl'.format(args.system)
+    with open(outfile, 'w') as f:
+        for record in validate(data, args.response, combos, runs=args.runs, fraction=args.fraction, group=args.group,
+                               workers=args.workers, seed=seed):
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            print("Run {:d}: combination {:d}, AICc {:f}, R_sq {:f}".format(record['run'], record['combo'], record['aicc'], record['rsquared']))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+'''
+The epistasis command: one entry point to the scripts of this repository.
+
+    epistasis likelihood ...    analysis/loglikelihood/loglikelihood_separation.py
+    epistasis figures ...       figures/scripts/render.py
+    epistasis rsq ...           figures/scripts/rsqparse.py
+
+Everything after the subcommand is passed to the script, which runs as it would on its own (so
+`epistasis likelihood --help` gives its flags). Only the standard library is imported here; each
+script imports what it needs, and the compute paths (the likelihood test, parsing and summarizing
+validation runs with rsq -noplot) leave matplotlib, pandas and scipy out until they are used.
+Installed with `pip install -e .` from the repository root, the scripts being run from the
+checkout.
+'''
+
+#---imports---#
+
+import argparse
+import os
+import runpy
+import sys
+
+#---constants---#
+
+root = os.path.dirname(os.path.abspath(__file__))
+
+#Subcommands: the directory and module of the script each one runs, and its help line
+commands = {
+    'likelihood' : ('analysis/loglikelihood', 'loglikelihood_separation', "Log-likelihood ratio test of epistasis against separation"),
+    'figures' : ('figures/scripts', 'render', "Render the manuscript figures of figures/manifest.json"),
+    'rsq' : ('figures/scripts', 'rsqparse', "Parse validation runs into delta R-sq summaries and plots"),
+}
+
+#---functions---#
+
+def run(command, argv):
+    '''Runs a subcommand's script as __main__ with argv as its arguments'''
+    directory, module, description = commands[command]
+    path = os.path.join(root, directory)
+    if not os.path.isfile(os.path.join(path, module + '.py')):
+        sys.exit("epistasis: {:s}/{:s}.py not found, install from a checkout with pip install -e .".format(directory, module))
+    sys.path.insert(0, path)
+    sys.argv = [module] + list(argv)
+    #alter_sys makes the script the __main__ module while it runs, so its functions can be sent to worker processes
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='epistasis',
+            description = "\n".join("  {:<12s}{:s}".format(name, command[2]) for name, command in commands.items()),
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command',
+            choices =   list(commands),
+            help    =   "Subcommand, see above. Pass --help after it for its own flags")
+    parser.add_argument('args',
+            nargs   =   argparse.REMAINDER,
+            help    =   "Arguments for the subcommand")
+    args = parser.parse_args(argv)
+    run(args.command, args.args)
+
+
+if __name__ == '__main__':
+    main()
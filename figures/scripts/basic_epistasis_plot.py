@@ -16,17 +16,36 @@ import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-from scipy.stats import pearsonr,linregress
-from matplotlib.pyplot import cm
-import pandas as pd
 from matplotlib import rc,rcParams
-import matplotlib.patches as mpatches
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'analysis', 'processing'))
+from tablecache import loadtable
 
 
 #---functions---#
 
 
-def plotter1(fs, out, ptype):
+def episplit(data, ptype, cutoff=0.5):
+    '''
+    Splits a table's double mutants by epistasis (ddG12 - (ddG1 + ddG2)) beyond +-cutoff.
+    Returns (additive sum, measured) point sets for no, positive and negative epistasis and the
+    axis limits
+    '''
+    X = data['ddG1'] + data['ddG2']
+    y = data['ddG12']
+    epistasis = y - X
+    null = (epistasis < cutoff)&(epistasis > -cutoff)
+    points = {'null' : (X[null], y[null]),
+              'pos' : (X[epistasis < -cutoff], y[epistasis < -cutoff]),
+              'neg' : (X[epistasis > cutoff], y[epistasis > cutoff])}
+    if ptype == "bind":
+        lims = [np.min([X,y])-1, np.max([X,y])+2]
+    elif ptype == "fold":
+        lims = [np.min([X,y])-3, np.max([X,y])+1.2]
+    return points, lims
+
+def plotter1(data, fs, out, ptype):
+    points, lims = episplit(data, ptype)
     rcParams['xtick.labelsize'] = fs
     rcParams['ytick.labelsize'] = fs
     rcParams['axes.labelsize'] = fs
@@ -34,9 +53,9 @@ def plotter1(fs, out, ptype):
     rcParams['font.family'] = 'serif'
     rc('text', usetex=True)
     plt.figure(figsize=(8,8))
-    plt.scatter(null_ep_x, null_ep_y, edgecolor='k', facecolor='None', label = 'No epistasis')
-    plt.scatter(pos_ep_x, pos_ep_y, edgecolor='red', facecolor='None', label = 'More stable than additive')
-    plt.scatter(neg_ep_x, neg_ep_y, edgecolor='blue', facecolor='None', label = 'Less stable than additive')
+    plt.scatter(*points['null'], edgecolor='k', facecolor='None', label = 'No epistasis')
+    plt.scatter(*points['pos'], edgecolor='red', facecolor='None', label = 'More stable than additive')
+    plt.scatter(*points['neg'], edgecolor='blue', facecolor='None', label = 'Less stable than additive')
     plt.legend(loc=4, prop={'size' : 20}, frameon=False, labelspacing=0, handletextpad=0)
     plt.ylabel('$\Delta\Delta$G$_{1,2}$ (kcal $\cdot$ mol$^{-1}$)')
     plt.xlabel('$\Delta\Delta$G$_{1}$ + $\Delta\Delta$G$_{2}$ (kcal $\cdot$ mol$^{-1}$)')
@@ -79,38 +98,9 @@ if __name__ == '__main__':
     args = parser.parse_args()
     
     try:
-    	data = pd.read_csv(args.i, sep='\t')
+    	data = loadtable(args.i)
     except:
         print("Error: Bad file specification")
         sys.exit(1)
 
-    X = data['ddG1'] + data['ddG2']
-    y = data['ddG12']
-
-    cutoff = 0.5
-
-    epistasis = y - X
-
-    pos_ep_x = X[epistasis < -cutoff]
-    neg_ep_x = X[epistasis > cutoff]
-    pos_ep_y = y[epistasis < -cutoff]
-    neg_ep_y = y[epistasis > cutoff]
-    null_ep_y = y[(epistasis < cutoff)&(epistasis > -cutoff)]
-    null_ep_x = X[(epistasis < cutoff)&(epistasis > -cutoff)]
-
-    fitdata = linregress(X,y)
-
-    def fit(x):
-        return float(fitdata[0])*x + float(fitdata[1])
-
-    fit_r = pearsonr(X,y)[0]
-
-    if args.ptype == "bind":
-        lims = [np.min([X,y])-1, np.max([X,y])+2]
-    elif args.ptype == "fold":
-        lims = [np.min([X,y])-3, np.max([X,y])+1.2]
-
-
-    sub_x = np.arange(min(X), max(X), 0.05)
-
-    plotter1(args.fs, args.o, args.ptype)
+    plotter1(data, args.fs, args.o, args.ptype)
@@ -15,30 +15,90 @@ For questions: j@jbsci.dev
 import numpy as np
 import pandas as pd
 import os,sys,argparse
-import seaborn as sns
 import matplotlib.pyplot as plt
 import matplotlib
 from matplotlib import rc,rcParams
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'analysis', 'processing'))
+from tablecache import loadtable
+
 #---functions---#
 
 
 def dataload(datafile, separator='\t'):
-    '''Loads datafile in specific format'''
+    '''Loads datafile in specific format, tab separated tables through their column cache'''
+    if separator == '\t':
+        return loadtable(datafile)
     return pd.read_csv(datafile, sep=separator)
 
+def categories(data, feature):
+    '''
+    The sorted categories of a feature, as strings, and the index of every row's category. The
+    values are factorized first so only the distinct ones are made strings and sorted
+    '''
+    codes, values = pd.factorize(np.asarray(data[feature]), use_na_sentinel=False)
+    cats, index = np.unique(np.array([str(value) for value in values]), return_inverse=True)
+    return [str(cat) for cat in cats], index.ravel()[codes]
+
 def FeatureHandler(datafile, feature):
     '''
-    Parses feature data to make plotting easier
+    Parses feature data to make plotting easier: the epistasis of every category of the feature,
+    in row order
+    '''
+    cats, codes = categories(datafile, feature)
+    ep = np.asarray(datafile['epistasis'], dtype=float)[np.argsort(codes, kind='stable')]
+    return dict(zip(cats, np.split(ep, np.cumsum(np.bincount(codes, minlength=len(cats)))[:-1])))
+
+class CutoffSweep:
+    '''
+    Breakdown of the epistasis into additive (ep_abs <= cutoff) and non-additive, and of the
+    non-additive into positive (epistasis < 0, more stable than additive) and negative, at any
+    number of cutoffs, overall or for every category of a feature. ep_abs is sorted once when the
+    sweep is made; each row then gets the key group*n + its position in that order, the group being
+    its category and sign, and the rows of a group below a cutoff are a range of the sorted keys,
+    so all groups at all cutoffs come from one searchsorted
     '''
-    ep = [item for item in datafile['epistasis']]
-    feat = [str(item) for item in datafile[feature]]
-    #Make dictionary with categories
-    feat_dict = {category : [] for category in np.unique(feat)}
-    #Populate dictionary
-    for i in range(len(ep)):
-        feat_dict[feat[i]].append(ep[i])
-    return feat_dict
+    def __init__(self, data, feature=None):
+        epabs = np.asarray(data['ep_abs'], dtype=float)
+        #0 for epistasis < 0, 1 for 0, 2 for > 0
+        sign = np.sign(np.asarray(data['epistasis'], dtype=float)).astype(int) + 1
+        self.feature = feature
+        if feature is None:
+            self.categories, codes = ['all'], np.zeros(len(epabs), dtype=int)
+        else:
+            self.categories, codes = categories(data, feature)
+        group = 3*codes + sign
+        order = np.argsort(epabs, kind='stable')
+        self.values = epabs[order]
+        self.keys = np.sort(group[order]*len(epabs) + np.arange(len(epabs)))
+        self.sizes = np.bincount(group, minlength=3*len(self.categories)).reshape(-1, 3)
+
+    def counts(self, cutoffs):
+        '''
+        Counts of rows, additive, non-additive, positive and negative at every cutoff, as arrays of
+        shape (categories, cutoffs), or (cutoffs,) for a sweep without a feature
+        '''
+        cutoffs = np.asarray(cutoffs, dtype=float)
+        below = np.searchsorted(self.values, cutoffs, side='right')
+        base = np.arange(self.sizes.size)[:,None]*len(self.values)
+        within = (np.searchsorted(self.keys, base + below[None,:]) - np.searchsorted(self.keys, base)).reshape(-1, 3, len(cutoffs))
+        rows = np.repeat(self.sizes.sum(axis=1)[:,None], len(cutoffs), axis=1)
+        additive = within.sum(axis=1)
+        result = {'rows' : rows, 'additive' : additive, 'nonadditive' : rows - additive,
+                  'positive' : self.sizes[:,0,None] - within[:,0], 'negative' : self.sizes[:,2,None] - within[:,2]}
+        if self.feature is None:
+            return {key : value[0] for key, value in result.items()}
+        return result
+
+    def fractions(self, cutoffs):
+        '''
+        As counts, with additive and non-additive as fractions of the rows and positive and
+        negative as fractions of the non-additive (nan where there are none)
+        '''
+        counts = self.counts(cutoffs)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return dict(counts, additive=counts['additive']/counts['rows'], nonadditive=counts['nonadditive']/counts['rows'],
+                        positive=counts['positive']/counts['nonadditive'], negative=counts['negative']/counts['nonadditive'])
 
 def draw_gaussian_at(support, sd, height, xpos, ypos,ax=None,**kwargs):
     if ax is None:
@@ -118,19 +178,9 @@ def featureErrorBarPlotter(data, feature, system, fs, feature_common_name, outpu
 
 
 def epistasis_split_cutoff(data, cutoff, norm=False):
-    ep = data['epistasis']
-    total = len(ep)
-    additive = data[data['ep_abs'] <= cutoff]
-    nonadditive = data[data['ep_abs'] > cutoff]
-    pos = len(nonadditive[nonadditive['epistasis'] < 0])
-    neg = len(nonadditive[nonadditive['epistasis'] > 0])
-    add = len(additive)
-    noadd = len(nonadditive)
-    if norm:
-        return add/total, noadd/total, pos/noadd, neg/noadd
-    else:
-        return add, noadd, pos, neg
-
+    sweep = CutoffSweep(data)
+    result = sweep.fractions([cutoff]) if norm else sweep.counts([cutoff])
+    return tuple(result[key][0] for key in ('additive', 'nonadditive', 'positive', 'negative'))
 
 
 def epistasis_presence_bar(data, cutoff_list, fs, systemlabel, output):
@@ -142,21 +192,12 @@ def epistasis_presence_bar(data, cutoff_list, fs, systemlabel, output):
     rc('text', usetex=True)
     width = 2/ len(cutoff_list)
     fig, (ax,ax2) = plt.subplots(2,1,sharex=True,figsize=(15,15))
-    ad = []
-    no = []
-    p = []
-    n = []
-    for i in range(len(cutoff_list)):
-        add, noadd, pos, neg = epistasis_split_cutoff(data, cutoff_list[i], norm=True)
-        ad.append(add)
-        no.append(noadd)
-        p.append(pos)
-        n.append(neg)
-    x = np.array([i for i in range(len(n))])
-    add = np.array(ad)
-    noadd = np.array(no)
-    pos = np.array(p)
-    neg = np.array(n)
+    breakdown = CutoffSweep(data).fractions(cutoff_list)
+    x = np.arange(len(cutoff_list))
+    add = breakdown['additive']
+    noadd = breakdown['nonadditive']
+    pos = breakdown['positive']
+    neg = breakdown['negative']
     ax.bar(x-width/2, add, width, color='k', label = 'No Epistasis (additive)')
     ax.bar(x+width/2, noadd, width, color='#543A91', label = 'Epistasis (non-additive)')
     ax2.bar(x-width/2, pos, width, color='b', label = 'More stable than predicted by additivity')
@@ -180,6 +221,52 @@ def epistasis_presence_bar(data, cutoff_list, fs, systemlabel, output):
     plt.savefig(output + '.pdf', format='pdf')
 
 
+def epistasis_sweep_plot(data, cutoffs, fs, systemlabel, output):
+    '''
+    The breakdown of epistasis_presence_bar as continuous curves over the cutoffs
+    '''
+    rcParams['xtick.labelsize'] = fs
+    rcParams['ytick.labelsize'] = fs
+    rcParams['axes.labelsize'] = fs
+    rcParams['legend.fontsize'] = fs
+    rcParams['font.family'] = 'serif'
+    rc('text', usetex=True)
+    breakdown = CutoffSweep(data).fractions(cutoffs)
+    fig, (ax,ax2) = plt.subplots(2,1,sharex=True,figsize=(15,15))
+    ax.plot(cutoffs, breakdown['additive'], color='k', label = 'No Epistasis (additive)')
+    ax.plot(cutoffs, breakdown['nonadditive'], color='#543A91', label = 'Epistasis (non-additive)')
+    ax2.plot(cutoffs, breakdown['positive'], color='b', label = 'More stable than predicted by additivity')
+    ax2.plot(cutoffs, breakdown['negative'], color='r', label = 'Less stable than predicted by additivity')
+    if systemlabel == "binding":
+        ax.set_title("Binding (SKEMPIv2.0)[572]", fontsize=fs)
+    elif systemlabel == "folding":
+        ax.set_title("Folding (ProTherm4)[204]", fontsize=fs)
+    else:
+        ax.set_title(systemlabel, fontsize=fs)
+    ax.set_ylim([0,1])
+    ax2.set_ylim([0,1])
+    ax.legend(loc=7, prop={'size' : 24}, frameon=False)
+    ax2.legend(loc=1, prop={'size' : 24}, frameon=False)
+    ax.set_ylabel('General Breakdown (norm.)')
+    ax2.set_ylabel('Sign Breakdown (norm.)')
+    ax2.set_xlabel('Additivity Cutoff (kcal/mol)')
+    plt.tight_layout()
+    plt.savefig(output + '.pdf', format='pdf')
+
+
+def breakdown_table(data, feature, cutoffs, output):
+    '''
+    Writes the breakdown of every category of a feature at every cutoff as a tab separated table
+    '''
+    sweep = CutoffSweep(data, feature)
+    counts = sweep.counts(cutoffs)
+    keys = ['rows', 'additive', 'nonadditive', 'positive', 'negative']
+    with open(output, 'w') as f:
+        f.write('\t'.join([feature, 'cutoff'] + keys) + '\n')
+        for i, category in enumerate(sweep.categories):
+            for j, cutoff in enumerate(cutoffs):
+                f.write('\t'.join([category, '{:g}'.format(cutoff)] + ['{:d}'.format(counts[key][i, j]) for key in keys]) + '\n')
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -205,6 +292,13 @@ if __name__ == '__main__':
     parser.add_argument('--presence_bar',
             action  =   'store_true',
             help    =   "Toggles presence bar output")
+    parser.add_argument('--sweep',
+            action  =   'store_true',
+            help    =   "Plots the presence breakdown as curves over the cutoffs instead, use a small --cutoffstep")
+    parser.add_argument('--breakdown',
+            type    =   str,
+            default =   None,
+            help    =   "Writes the breakdown of every category of --feature at the cutoffs to this table instead of plotting")
     parser.add_argument('--fs',
             type    =   int,
             default =   28,
@@ -249,10 +343,14 @@ if __name__ == '__main__':
         sys.exit(1)
     args = parser.parse_args()
     data = dataload(args.data)
-    if args.presence_bar is False:
+    cutofflist = list(np.arange(args.cutoffmin, args.cutoffmax+args.cutoffstep, args.cutoffstep))
+    if args.breakdown is not None:
+        breakdown_table(data, args.feature, cutofflist, args.breakdown)
+    elif args.sweep:
+        epistasis_sweep_plot(data, cutofflist, args.fs, args.system, args.output)
+    elif args.presence_bar is False:
         featureErrorBarPlotter(data, args.feature, args.system, args.fs, args.simplename, args.output, args.titleside, args.figsize, args.titleshift, args.rot, args.fsadj, args.stripnum)
     elif args.presence_bar:
-        cutofflist = list(np.arange(args.cutoffmin, args.cutoffmax+args.cutoffstep, args.cutoffstep))
         epistasis_presence_bar(data, cutofflist, args.fs, args.system, args.output)
 
 
@@ -18,7 +18,7 @@ def plotter1(sim,lm, fs, out, ptype):
     rcParams['font.family'] = 'serif'
     rc('text', usetex=True)
     plt.figure(figsize=(7.5,7.5))
-    ultamin = min([loglam, min(simulated)])
+    ultamin = min([lm, min(sim)])
     ht = plt.hist(sim, color='k')
     plt.ylabel('Frequency')
     plt.xlabel(r'Log-Likelihood Ratio ($\Lambda$)')
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+'''
+Batch renderer for the manuscript figures listed in figures/manifest.json.
+
+Every manifest entry names a figure kind (one of the plotting functions of the scripts in this
+directory), its inputs, its parameters and its output, paths being relative to the manifest.
+Each input is loaded once in this process, however many figures use it, and the figures are then
+drawn in parallel by worker processes that are handed the loaded data. A figure is drawn again
+only when its entry, the size or modification time of one of its inputs, of the script drawing
+it or of a local module that script or the loading of its inputs imports (tablecache.py, ...) has
+changed since its last render, or when one of its outputs is missing; what was last rendered is
+kept in .render_state.json next to the manifest.
+'''
+
+#---imports---#
+
+import numpy as np
+import argparse
+import ast
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+processingdir = os.path.join(scriptdir, '..', '..', 'analysis', 'processing')
+sys.path.insert(0, scriptdir)
+sys.path.insert(0, processingdir)
+from tablecache import loadtable, stamp
+
+#matplotlib and the figure scripts are imported once there's something to draw, so checking an
+#up to date manifest doesn't load them
+
+#---constants---#
+
+manifestfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'manifest.json')
+
+#Figure kinds: the script drawing them, how each input is loaded, the parameters with the script's
+#defaults, the call drawing the figure and the files it writes
+figures = {
+    'epistasis' : {'script' : 'basic_epistasis_plot', 'inputs' : {'data' : 'table'},
+                   'defaults' : {'fs' : 28, 'ptype' : 'bind'},
+                   'draw' : lambda script, data, p, out: script.plotter1(data['data'], p['fs'], out, p['ptype']),
+                   'outputs' : lambda p, out: [out + '.pdf']},
+    'sepdist' : {'script' : 'sepdist_compare', 'inputs' : {'bind' : 'table', 'fold' : 'table'},
+                 'defaults' : {'fs' : 32},
+                 'draw' : lambda script, data, p, out: script.plotter1(
+                     (data['bind']['epistasis'].to_numpy(), data['bind']['separation'].to_numpy()),
+                     (data['fold']['epistasis'].to_numpy(), data['fold']['separation'].to_numpy()), p['fs'], out),
+                 'outputs' : lambda p, out: [out + '.pdf']},
+    'altdiag' : {'script' : 'loglikealtdiag', 'inputs' : {},
+                 'defaults' : {'fs' : 28, 'npoints' : 20},
+                 'draw' : lambda script, data, p, out: script.bindplotgenAltNull(p['npoints'], p['fs'], out),
+                 'outputs' : lambda p, out: [out + '.pdf']},
+    'loglike' : {'script' : 'loglikeplotter', 'inputs' : {'sim' : 'array', 'exp' : 'array'},
+                 'defaults' : {'fs' : 28, 'ptype' : 'bind'},
+                 'draw' : lambda script, data, p, out: script.plotter1(data['sim'], float(data['exp']), p['fs'], out, p['ptype']),
+                 'outputs' : lambda p, out: [out + '.pdf']},
+    'feature' : {'script' : 'feature_cat_compare', 'inputs' : {'data' : 'table'},
+                 'defaults' : {'feature' : 'cplx_type2', 'system' : 'binding', 'simplename' : 'Complex Type', 'fs' : 28,
+                               'rot' : 0, 'fsadj' : 0, 'titleside' : 'left', 'figsize' : '8x8', 'titleshift' : 0,
+                               'stripnum' : False},
+                 'draw' : lambda script, data, p, out: script.featureErrorBarPlotter(data['data'], p['feature'], p['system'],
+                     p['fs'], p['simplename'], out, p['titleside'], p['figsize'], p['titleshift'], p['rot'], p['fsadj'], p['stripnum']),
+                 'outputs' : lambda p, out: [out + '.pdf']},
+    'presence' : {'script' : 'feature_cat_compare', 'inputs' : {'data' : 'table'},
+                  'defaults' : {'system' : 'binding', 'fs' : 28, 'cutoffmin' : 0.1, 'cutoffmax' : 1.0, 'cutoffstep' : 0.1},
+                  'draw' : lambda script, data, p, out: script.epistasis_presence_bar(data['data'],
+                      list(np.arange(p['cutoffmin'], p['cutoffmax']+p['cutoffstep'], p['cutoffstep'])), p['fs'], p['system'], out),
+                  'outputs' : lambda p, out: [out + '.pdf']},
+    'sweep' : {'script' : 'feature_cat_compare', 'inputs' : {'data' : 'table'},
+               'defaults' : {'system' : 'binding', 'fs' : 28, 'cutoffmin' : 0.1, 'cutoffmax' : 1.0, 'cutoffstep' : 0.1},
+               'draw' : lambda script, data, p, out: script.epistasis_sweep_plot(data['data'],
+                   np.arange(p['cutoffmin'], p['cutoffmax']+p['cutoffstep'], p['cutoffstep']), p['fs'], p['system'], out),
+               'outputs' : lambda p, out: [out + '.pdf']},
+    'rsq' : {'script' : 'rsqparse', 'inputs' : {'runs' : 'runs'},
+             'defaults' : {'system' : 'bind', 'fs' : 28, 'numruns' : 100, 'summary' : False},
+             'draw' : lambda script, data, p, out: (script.rsqplots(data['runs'], p['system'], p['fs'], out),
+                                                    script.writesummary(data['runs'], out) if p['summary'] else None),
+             'outputs' : lambda p, out: [out + 'leave_10per_out_{:s}.pdf'.format(p['system']),
+                                         out + 'leave_10per_out_{:s}_errb.pdf'.format(p['system'])]},
+}
+
+#Parameters the loading of an input depends on, by how it's loaded
+loadparams = {'table' : [], 'array' : [], 'runs' : ['system', 'numruns']}
+
+#Local modules doing the loading of an input, by how it's loaded
+loadmodules = {'table' : ['tablecache'], 'array' : [], 'runs' : ['rsqparse']}
+
+#Directories local modules are found in, as the scripts put them on sys.path
+localdirs = [scriptdir, processingdir]
+
+#Inputs loaded by the main process, handed to the workers
+datasets = {}
+
+#---functions---#
+
+def readmanifest(manifest):
+    '''
+    The figures of a manifest, as {name : (kind, {input : absolute path}, parameters with the
+    defaults filled in, absolute output)}
+    '''
+    with open(manifest, 'r') as f:
+        entries = json.load(f)
+    root = os.path.dirname(os.path.abspath(manifest))
+    jobs = {}
+    for name, entry in entries.items():
+        if entry['figure'] not in figures:
+            raise ValueError("{:s}: unknown figure kind {:s}".format(name, entry['figure']))
+        spec = figures[entry['figure']]
+        if set(entry['inputs']) != set(spec['inputs']):
+            raise ValueError("{:s}: {:s} takes the inputs {}".format(name, entry['figure'], sorted(spec['inputs'])))
+        unknown = set(entry.get('params', {})) - set(spec['defaults'])
+        if unknown:
+            raise ValueError("{:s}: unknown parameters {}".format(name, sorted(unknown)))
+        inputs = {key : os.path.join(root, path) for key, path in entry['inputs'].items()}
+        params = dict(spec['defaults'], **entry.get('params', {}))
+        jobs[name] = (entry['figure'], inputs, params, os.path.join(root, entry['output']))
+    return jobs
+
+def datakey(loader, path, params):
+    '''Key of a loaded input, shared by every figure loading the same file the same way'''
+    return (loader, os.path.normpath(path)) + tuple(params[key] for key in loadparams[loader])
+
+def loadinput(loader, path, params):
+    '''Loads one input: a processed table, a text array or the delta R-sq of validation runs'''
+    if loader == 'table':
+        return loadtable(path)
+    if loader == 'array':
+        return np.loadtxt(path)
+    rsqparse = importlib.import_module('rsqparse')
+    if os.path.isdir(path):
+        return rsqparse.readruns(path, None, params['system'], params['numruns'], os.path.join(path, '.rsqparse_cache.npz'))
+    return rsqparse.readruns(None, path, params['system'], params['numruns'], os.path.join(os.path.dirname(path), '.rsqparse_cache.npz'))
+
+def inputstamp(path):
+    '''Size and modification time of an input file, or of every file under an input directory but hidden ones'''
+    if not os.path.isdir(path):
+        return stamp(path)
+    stamps = []
+    for head, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        stamps += [[os.path.relpath(os.path.join(head, name), path)] + stamp(os.path.join(head, name))
+                   for name in sorted(files) if not name.startswith('.')]
+    return stamps
+
+def localmodules(module, found=None):
+    '''
+    Paths of a local module (one in localdirs) and of every local module it imports, however
+    deeply. Other modules are skipped
+    '''
+    found = set() if found is None else found
+    paths = [os.path.normpath(os.path.join(d, module + '.py')) for d in localdirs]
+    paths = [path for path in paths if os.path.isfile(path)]
+    if not paths or paths[0] in found:
+        return found
+    found.add(paths[0])
+    with open(paths[0], 'r') as f:
+        tree = ast.parse(f.read(), paths[0])
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            localmodules(name.split('.')[0], found)
+    return found
+
+def digest(job):
+    '''
+    Hash of everything a figure depends on: its entry and the stamps of its inputs, of its script
+    and of the local modules its script and input loaders import
+    '''
+    kind, inputs, params, output = job
+    spec = figures[kind]
+    modules = set()
+    for module in [spec['script']] + [m for loader in spec['inputs'].values() for m in loadmodules[loader]]:
+        localmodules(module, modules)
+    key = {'figure' : kind, 'params' : params, 'output' : output,
+           'modules' : {path : stamp(path) for path in sorted(modules)},
+           'inputs' : {name : [path, inputstamp(path)] for name, path in inputs.items()}}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def setdatasets(loaded):
+    '''Worker initializer, hands the loaded inputs to a worker'''
+    datasets.update(loaded)
+
+def drawfigure(named):
+    '''
+    Draws one figure from the loaded inputs, with the script's rc settings kept to this figure.
+    Returns the name, the time taken and the error if it failed (None otherwise)
+    '''
+    name, (kind, inputs, params, output) = named
+    spec = figures[kind]
+    start = time.time()
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    try:
+        data = {key : datasets[datakey(spec['inputs'][key], path, params)] for key, path in inputs.items()}
+        with matplotlib.rc_context():
+            spec['draw'](importlib.import_module(spec['script']), data, params, output)
+        error = None
+    except Exception as failure:
+        error = "{:s}: {}".format(type(failure).__name__, failure)
+    finally:
+        plt.close('all')
+    return name, time.time() - start, error
+
+def render(manifest, names=None, force=False, workers=1, statefile=None):
+    '''
+    Renders the figures of a manifest (names, all by default) that changed since the last render,
+    or all of them if force. Yields (name, seconds, error) as figures finish, saving the render
+    state after each one drawn without error
+    '''
+    jobs = readmanifest(manifest)
+    names = list(jobs) if not names else names
+    missing = [name for name in names if name not in jobs]
+    if missing:
+        raise KeyError("Figures not in {:s}: {}".format(manifest, missing))
+    statefile = statefile if statefile is not None else os.path.join(os.path.dirname(os.path.abspath(manifest)), '.render_state.json')
+    try:
+        with open(statefile, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    digests = {name : digest(jobs[name]) for name in names}
+    stale = [name for name in names if force or state.get(name) != digests[name]
+             or not all(os.path.exists(out) for out in figures[jobs[name][0]]['outputs'](jobs[name][2], jobs[name][3]))]
+    loaded = {}
+    for name in stale:
+        kind, inputs, params, output = jobs[name]
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        for key, path in inputs.items():
+            loader = figures[kind]['inputs'][key]
+            if datakey(loader, path, params) not in loaded:
+                loaded[datakey(loader, path, params)] = loadinput(loader, path, params)
+    if stale:
+        import matplotlib
+        matplotlib.use('Agg')
+    for name in stale:
+        importlib.import_module(figures[jobs[name][0]]['script'])
+    work = [(name, jobs[name]) for name in stale]
+    if workers > 1 and len(work) > 1:
+        pool = Pool(min(workers, len(work)), initializer=setdatasets, initargs=(loaded,))
+        finished = pool.imap_unordered(drawfigure, work)
+    else:
+        pool = None
+        setdatasets(loaded)
+        finished = map(drawfigure, work)
+    try:
+        for name, seconds, error in finished:
+            if error is None:
+                state[name] = digests[name]
+                with open(statefile + '.tmp', 'w') as f:
+                    json.dump(state, f, indent=1, sort_keys=True)
+                os.replace(statefile + '.tmp', statefile)
+            yield name, seconds, error
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names',
+            nargs   =   '*',
+            help    =   "Figures to render, e.g. Fig1A S3C, defaults to all of the manifest")
+    parser.add_argument('--manifest',
+            type    =   str,
+            default =   manifestfile,
+            help    =   "Figure manifest, defaults to figures/manifest.json")
+    parser.add_argument('--workers',
+            type    =   int,
+            default =   os.cpu_count(),
+            help    =   "Number of processes drawing figures")
+    parser.add_argument('--force',
+            action  =   'store_true',
+            help    =   "Render every figure asked for, changed or not")
+    parser.add_argument('--state',
+            type    =   str,
+            default =   None,
+            help    =   "Render state file, defaults to .render_state.json next to the manifest")
+    args = parser.parse_args()
+    failed = 0
+    drawn = 0
+    for name, seconds, error in render(args.manifest, args.names, args.force, args.workers, args.state):
+        drawn += 1
+        if error is not None:
+            failed += 1
+            print("{:s}: failed, {:s}".format(name, error))
+        else:
+            print("{:s}: {:.1f} s".format(name, seconds))
+    if drawn == 0:
+        print("All figures up to date")
+    sys.exit(1 if failed else 0)
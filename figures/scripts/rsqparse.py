@@ -2,10 +2,11 @@
 
 import os
 import sys
+import json
 import argparse
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib import rc,rcParams
+
+#matplotlib is imported in rsqplots, so parsing and summarizing runs doesn't load it
 
 #-# functions #-#
 
@@ -26,12 +27,175 @@ def splitrsq(datafile,typing):
     result_dict = { elem.split(':')[0] : float(elem.split(':')[1]) for elem in combined}
     return result_dict
 
-def pull_coeff(datafile):
-    '''Pulls coefficients'''
+def rline(line):
+    '''
+    Contents of an R print line, without the [1] index and the quotes bind output has
+    '''
+    return line.split(']', 1)[1].strip().replace('"', '') if line.startswith('[') else line.strip()
+
+def coeffrow(line):
+    '''
+    One row of an R coefficient table as (name, (estimate, std. error, t value, p)), NA as nan
+    '''
+    tokens = line.split()
+    name, values = tokens[0], tokens[1:]
+    if len(values) > 4 and values[3] == '<':
+        values = values[:3] + values[4:]
+    values = [float(v.lstrip('<')) if v != 'NA' else np.nan for v in values[:4]]
+    return name, tuple(values)
+
+def iterruns(datafile):
+    '''
+    Streams the runs of combined validation output (leave_10per_out_*.txt), split on the
+    \newentry marker. Yields one dict per run with its index, the removed complexes, the length of
+    the new dataset (None if not printed), the delta R-sq ranking, the coefficient table and the
+    multiple R-sq of the final model. Reads a line at a time, so memory doesn't grow with the file.
+    The JSON lines written by analysis/validation/validation.py (.jsonl) are read as they are
+    '''
+    if datafile.endswith('.jsonl'):
+        with open(datafile, 'r') as f:
+            for line in f:
+                run = json.loads(line)
+                run['coefficients'] = {name : tuple(values) for name, values in run['coefficients'].items()}
+                yield run
+        return
+    run = None
+    section = None
     with open(datafile, 'r') as f:
-        f = f.readlines()
-        coef = f[f.index("Call:\n")+9:]
-    sep = coef[[i for i, elem in enumerate(ceof) if "separation " in elem][0]]
+        for line in f:
+            text = rline(line)
+            if '\\newentry' in line:
+                if run is not None:
+                    yield run
+                run = {'run' : None, 'removed' : [], 'length' : None, 'rsq' : {}, 'coefficients' : {}, 'rsquared' : None}
+                section = 'run'
+            elif run is None:
+                continue
+            elif text.startswith('removed complexes'):
+                section = 'removed'
+            elif text.startswith('Length of new dataset'):
+                section = 'length'
+            elif text.startswith('R_sq ranking'):
+                section = 'rsq'
+            elif text.startswith('Call:'):
+                section = None
+            elif text.startswith('Coefficients'):
+                section = 'coefheader'
+            elif text.startswith('Multiple R-squared'):
+                run['rsquared'] = float(text.split(':')[1].split(',')[0])
+            elif section == 'run' and line.startswith('['):
+                run['run'] = int(text)
+                section = None
+            elif section == 'removed' and line.startswith('['):
+                run['removed'] += text.split()
+            elif section == 'length' and line.startswith('['):
+                run['length'] = int(text)
+                section = None
+            elif section == 'rsq' and line.startswith('[1]'):
+                key, value = text.split(':', 1)
+                run['rsq'][key] = float(value)
+            elif section == 'coefheader':
+                section = 'coef'
+            elif section == 'coef':
+                if not text or text.startswith('---'):
+                    section = None
+                else:
+                    name, values = coeffrow(text)
+                    run['coefficients'][name] = values
+    if run is not None:
+        yield run
+
+def filestamp(path):
+    '''
+    Size and modification time of a file, what the parse cache is keyed on
+    '''
+    st = os.stat(path)
+    return int(st.st_size), int(st.st_mtime_ns)
+
+def loadcache(cachefile):
+    '''
+    Reads the parse cache, a compressed table with one row per parsed run. Returns a dict mapping
+    (path, system) to the file stamp and the list of parsed {feature : delta R-sq} dicts of the
+    file's runs, with the features in the order they appear in the file
+    '''
+    if cachefile is None or not os.path.exists(cachefile):
+        return {}
+    with np.load(cachefile) as cache:
+        if 'runs' not in cache.files:
+            return {}
+        features = [str(feat) for feat in cache['features']]
+        values = cache['values']
+        order = cache['order']
+        entries = {}
+        for i, (path, system, size, mtime) in enumerate(zip(cache['paths'], cache['systems'], cache['sizes'], cache['mtimes'])):
+            present = np.flatnonzero(order[i] >= 0)
+            present = present[np.argsort(order[i, present])]
+            entry = entries.setdefault((str(path), str(system)), ((int(size), int(mtime)), []))
+            entry[1].append({features[j] : float(values[i, j]) for j in present})
+    return entries
+
+def savecache(cachefile, entries):
+    '''
+    Writes the parse cache as a run x feature table of delta R-sq (the full model R-sq is the
+    "Full model" column) plus each feature's position in its run, the file every run came from
+    and the run's index in that file
+    '''
+    rows = [(key, stamp, k, result) for key, (stamp, results) in entries.items() for k, result in enumerate(results)]
+    features = list(dict.fromkeys(feat for key, stamp, k, result in rows for feat in result))
+    column = {feat : j for j, feat in enumerate(features)}
+    values = np.full((len(rows), len(features)), np.nan)
+    order = np.full((len(rows), len(features)), -1, dtype=np.int32)
+    for i, (key, stamp, k, result) in enumerate(rows):
+        for pos, (feat, value) in enumerate(result.items()):
+            values[i, column[feat]] = value
+            order[i, column[feat]] = pos
+    #written next to the cache and moved over it, so an interrupted run never leaves it half written
+    with open(cachefile + '.tmp', 'wb') as f:
+        np.savez_compressed(f, paths=np.array([key[0] for key, stamp, k, result in rows], dtype=str),
+                systems=np.array([key[1] for key, stamp, k, result in rows], dtype=str),
+                sizes=np.array([stamp[0] for key, stamp, k, result in rows], dtype=np.int64),
+                mtimes=np.array([stamp[1] for key, stamp, k, result in rows], dtype=np.int64),
+                runs=np.array([k for key, stamp, k, result in rows], dtype=np.int32),
+                features=np.array(features, dtype=str), values=values, order=order)
+    os.replace(cachefile + '.tmp', cachefile)
+
+def parsecached(datafiles, typing, parse, cachefile=None):
+    '''
+    Parses every file with parse(datafile, typing), which returns the list of the file's runs,
+    through the parse cache. Files whose size and modification time match the cache are not read
+    again, new or changed ones are parsed and added to it. Returns the runs of all files in order
+    '''
+    entries = loadcache(cachefile)
+    results = []
+    changed = False
+    for datafile in datafiles:
+        key = (os.path.abspath(datafile), typing)
+        stamp = filestamp(datafile)
+        if key not in entries or entries[key][0] != stamp:
+            entries[key] = (stamp, parse(datafile, typing))
+            changed = True
+        results += entries[key][1]
+    if cachefile is not None and changed:
+        savecache(cachefile, entries)
+    return results
+
+def splitrsqcached(datafiles, typing, cachefile=None):
+    '''
+    splitrsq for a list of run files, through the parse cache
+    '''
+    return parsecached(datafiles, typing, lambda datafile, typing: [splitrsq(datafile, typing)], cachefile)
+
+def combinedrsqcached(datafile, typing, cachefile=None):
+    '''
+    Delta R-sq of every run in combined validation output, through the parse cache
+    '''
+    return parsecached([datafile], typing, lambda datafile, typing: [run['rsq'] for run in iterruns(datafile)], cachefile)
+
+def pull_coeff(datafile):
+    '''
+    Pulls coefficients of a run file as {term : (estimate, std. error, t value, p)}
+    '''
+    return next(iterruns(datafile))['coefficients']
 
 
 def keyfix(key):
@@ -55,107 +219,141 @@ def rankconvert(instance_dict):
     Converts list of delta r-square to rank order
     '''
     sorteddrsq = sorted(instance_dict.keys())[::-1][1:]
-    asfeat = [instance_dict[elem] for elem in sorteddrsq]
-    rankorder = { feat : asfeat.index(feat)+1 for feat in asfeat }
+    rankorder = { instance_dict[elem] : i+1 for i, elem in enumerate(sorteddrsq) }
     return rankorder
 
+def runmatrix(results):
+    '''
+    Dense run x feature matrix of delta R-sq from a list of parsed runs, with the abstracted
+    features merged by keyfix (the last one in a run wins, as in a dict). Features are in order of
+    first appearance. Returns the features, the values and the mask of features present in each run
+    '''
+    fixed = [{keyfix(k) : v for k,v in result.items()} for result in results]
+    features = list(dict.fromkeys(key for run in fixed for key in run))
+    column = {feat : j for j, feat in enumerate(features)}
+    values = np.full((len(fixed), len(features)), np.nan)
+    for i, run in enumerate(fixed):
+        values[i, [column[key] for key in run]] = list(run.values())
+    return features, values, ~np.isnan(values)
 
+def rankmatrix(values, present):
+    '''
+    Rank of every present feature within its run by decreasing delta R-sq, as rankconvert does:
+    the top value (the full model R-sq) is left out and the next one is rank 1. nan where unranked
+    '''
+    order = np.argsort(np.where(present, -values, np.inf), axis=1, kind='stable')
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, np.arange(values.shape[1], dtype=float)[None,:], axis=1)
+    ranks[~present | (ranks == 0)] = np.nan
+    return ranks
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-dataroot', help="Data root direcotry")
-    parser.add_argument('-outdir', help="output directory, defaults to current", default="./")
-    parser.add_argument('-numruns', type=int, help="number of runs to process, defaults to 100", default=100)
-    parser.add_argument('-system', help="System, either bind or fold", default="bind")
-    parser.add_argument('-summary',help="Will write summary if specified", action="store_true")
-    parser.add_argument('-fs', help="Font size", default=28, type=int)
-    if len(sys.argv) == 1:
-        parser.print_help()
-        sys.exit(1)
-    args = parser.parse_args()
-    combodict_raw = { "{:02d}".format(i) : splitrsq("{:s}/run_{:02d}/run_{:02d}.txt".format(args.dataroot,i,i), args.system) for i in range(0,args.numruns)}
-    combodict = {}
-    for i in range(args.numruns):
-        j = "{:02d}".format(i)
-        combodict[j] = {keyfix(k) : v for k,v in combodict_raw[j].items()}
-
-    avg_model_size = int(max([len(combodict["{:02d}".format(i)].keys()) - 1 for i in range(args.numruns)]))
-
-    revcombodict = {}
-    for i in range(args.numruns):
-        j = "{:02d}".format(i)
-        revcombodict[j] = {v : k for k,v in combodict[j].items()}
-
-    rankorderdict = {}
-    for i in range(100):
-        j = "{:02d}".format(i)
-        rankorderdict[j] = rankconvert(revcombodict[j])
-
-    allkeys = []
-    allkeys_total = {}
-    for i in range(0,args.numruns):
-        for key in combodict["{:02d}".format(i)]:
-            if key not in allkeys:
-                allkeys.append(key)
-            if key not in allkeys_total.keys():
-                allkeys_total[key] = 0
-            allkeys_total[key] += 1
-
-    value_dict = {}
-    for feature in allkeys:
-        value_dict[feature] = []
-        for i in range(0,args.numruns):
-            try:
-                value_dict[feature].append(combodict["{:02d}".format(i)][feature])
-            except:
-                value_dict[feature].append(0)
-
-    rankavg_dict = {}
-    for feature in allkeys:
-        rankavg_dict[feature] = []
-        for i in range(args.numruns):
-            try:
-                rankavg_dict[feature].append(rankorderdict["{:02d}".format(i)][feature])
-            except:
-                pass
-    rcParams['xtick.labelsize'] = args.fs
-    rcParams['ytick.labelsize'] = args.fs
-    rcParams['axes.labelsize'] = args.fs
-    rcParams['legend.fontsize'] = args.fs
+def summarize(values, present):
+    '''
+    Per-feature summaries of a run x feature matrix: runs including the feature (count and
+    percent), average delta R-sq over those runs, mean and standard deviation over all runs with
+    absent features counted as 0, and average rank
+    '''
+    nruns = len(values)
+    count = present.sum(axis=0)
+    filled = np.where(present, values, 0)
+    ranks = rankmatrix(values, present)
+    ranked = ~np.isnan(ranks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'count' : count, 'percent' : 100*count/nruns, 'average' : filled.sum(axis=0)/count,
+                'mean' : filled.mean(axis=0), 'std' : filled.std(axis=0, ddof=1),
+                'rank' : np.where(ranked, ranks, 0).sum(axis=0)/ranked.sum(axis=0)}
+
+def readruns(dataroot, combined, system, numruns, cachefile=None):
+    '''
+    Delta R-sq of the first numruns runs, from the combined validation output if given, else from
+    the run directories under dataroot
+    '''
+    if combined is not None:
+        return combinedrsqcached(combined, system, cachefile)[:numruns]
+    runfiles = ["{:s}/run_{:02d}/run_{:02d}.txt".format(dataroot,i,i) for i in range(0,numruns)]
+    return splitrsqcached(runfiles, system, cachefile)
+
+def writesummary(results, outdir):
+    '''
+    Writes the average rank, average delta R-sq and number of models of every feature to
+    validation_data.txt in outdir
+    '''
+    features, values, present = runmatrix(results)
+    summary = summarize(values, present)
+    with open(outdir + 'validation_data.txt', 'w') as f:
+        f.write("Average Rank\n")
+        for key, rank in zip(features, summary['rank']):
+            f.write("{:s}\t{:.3f}\n".format(key, rank))
+        f.write("\n")
+        f.write("Average delta Rsq\n")
+        for key, average in zip(features, summary['average']):
+            f.write("{:s}\t{:.3f}\n".format(key, average))
+        f.write("\n")
+        f.write("Number of models:\n")
+        for key, count in zip(features, summary['count']):
+            f.write("{:s}\t{:.3f}\n".format(key, count))
+
+def rsqplots(results, system, fs, outdir):
+    '''
+    Draws the delta R-sq of every run (leave_10per_out_{system}.pdf) and each feature's mean and
+    spread over the runs (leave_10per_out_{system}_errb.pdf) to outdir
+    '''
+    import matplotlib.pyplot as plt
+    from matplotlib import rcParams
+    features, values, present = runmatrix(results)
+    summary = summarize(values, present)
+    filled = np.where(present, values, 0)
+
+    rcParams['xtick.labelsize'] = fs
+    rcParams['ytick.labelsize'] = fs
+    rcParams['axes.labelsize'] = fs
+    rcParams['legend.fontsize'] = fs
     rcParams['font.family'] = 'serif'
 
     f = plt.figure(figsize=(8,8))
-    for key in allkeys:
-        plt.plot([i for i in range(0,args.numruns)], value_dict[key], label="{:s}: {:d}%, dR^2 avg: {:.3f}".format(key, allkeys_total[key], np.average([elem for elem in value_dict[key] if elem != 0])))
+    for j, key in enumerate(features):
+        plt.plot(np.arange(len(results)), filled[:,j], label="{:s}: {:.0f}%, dR^2 avg: {:.3f}".format(key, summary['percent'][j], summary['average'][j]))
     lgd = plt.legend(bbox_to_anchor=(-0.18,-0.92), loc='lower left')
     plt.xlabel("run")
     plt.ylabel(r"$\Delta R^{2}$")
-    if args.system == "bind":
-        plt.title("Binding (SKEMPIv2.0)", y=0.94, fontsize=args.fs)
-    elif args.system == "fold":
-        plt.title("Folding (ProTherm4)", y=0.94, fontsize=args.fs)
-    plt.savefig(args.outdir + 'leave_10per_out_{:s}.pdf'.format(args.system), format='pdf', dpi=300, bbox_extra_artists=(lgd,), bbox_inches="tight")
+    if system == "bind":
+        plt.title("Binding (SKEMPIv2.0)", y=0.94, fontsize=fs)
+    elif system == "fold":
+        plt.title("Folding (ProTherm4)", y=0.94, fontsize=fs)
+    plt.savefig(outdir + 'leave_10per_out_{:s}.pdf'.format(system), format='pdf', dpi=300, bbox_extra_artists=(lgd,), bbox_inches="tight")
 
     plt.clf()
     f = plt.figure(figsize=(8,8))
     #plot errorbar plot
-    for i in range(len(allkeys)):
-        plt.errorbar(i, np.average(value_dict[allkeys[i]]), xerr=0, yerr=np.std(value_dict[allkeys[i]], ddof=1), marker='o', capsize=7, elinewidth=5, capthick=3)
-    plt.xticks([i for i in range(len(allkeys))], [allkeys[i] for i in range(len(allkeys))], rotation=75)
+    for j in range(len(features)):
+        plt.errorbar(j, summary['mean'][j], xerr=0, yerr=summary['std'][j], marker='o', capsize=7, elinewidth=5, capthick=3)
+    plt.xticks(np.arange(len(features)), features, rotation=75)
     plt.ylabel(r"$\Delta R^{2}$")
     plt.xlabel("Feature")
-    plt.savefig(args.outdir + 'leave_10per_out_{:s}_errb.pdf'.format(args.system), format='pdf', dpi=300, bbox_inches="tight")
+    plt.savefig(outdir + 'leave_10per_out_{:s}_errb.pdf'.format(system), format='pdf', dpi=300, bbox_inches="tight")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-dataroot', help="Data root direcotry")
+    parser.add_argument('-combined', help="Combined validation output (leave_10per_out_*.txt) to read the runs from instead of -dataroot", default=None)
+    parser.add_argument('-outdir', help="output directory, defaults to current", default="./")
+    parser.add_argument('-numruns', type=int, help="number of runs to process, defaults to 100", default=100)
+    parser.add_argument('-system', help="System, either bind or fold", default="bind")
+    parser.add_argument('-summary',help="Will write summary if specified", action="store_true")
+    parser.add_argument('-noplot', help="Skip the plots, e.g. to only write the summary", action="store_true")
+    parser.add_argument('-fs', help="Font size", default=28, type=int)
+    parser.add_argument('-cache', help="Parse cache file, defaults to .rsqparse_cache.npz in the data root or next to -combined", default=None)
+    parser.add_argument('-nocache', help="Parse every run file again and don't keep a cache", action="store_true")
+    if len(sys.argv) == 1:
+        parser.print_help()
+        sys.exit(1)
+    args = parser.parse_args()
+    cacheroot = args.dataroot if args.combined is None else os.path.dirname(os.path.abspath(args.combined))
+    cachefile = None if args.nocache else (args.cache if args.cache is not None else os.path.join(cacheroot, '.rsqparse_cache.npz'))
+    results = readruns(args.dataroot, args.combined, args.system, args.numruns, cachefile)
+    if not args.noplot:
+        rsqplots(results, args.system, args.fs, args.outdir)
     #Provides summary data if desired
     if args.summary:
-        with open(args.outdir + 'validation_data.txt', 'w') as f:
-            f.write("Average Rank\n")
-            for key in allkeys:
-                f.write("{:s}\t{:.3f}\n".format(key, np.average(rankavg_dict[key])))
-            f.write("\n")
-            f.write("Average delta Rsq\n")
-            for key in allkeys:
-                f.write("{:s}\t{:.3f}\n".format(key, np.average([elem for elem in value_dict[key] if elem != 0])))
-            f.write("\n")
-            f.write("Number of models:\n")
-            for key in allkeys:
-                f.write("{:s}\t{:.3f}\n".format(key, allkeys_total[key]))
+        writesummary(results, args.outdir)
@@ -7,10 +7,11 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import gaussian_kde
 import os,sys,argparse
 from matplotlib import rc, rcParams
-import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'analysis', 'processing'))
+from tablecache import loadcolumns
 
 
 #--# Functions 
@@ -30,15 +31,20 @@ def pairPropEpSplitter(epistasis_data, aux_property):
     return neg_ep, neg_ep_aux, ps_ep, ps_ep_aux, standardEp, standardAux
 
 
-def plotter1(fs, outfile):
+def plotter1(bind, fold, fs, outfile):
+    '''
+    Epistasis against separation for binding and folding, bind and fold given as
+    (epistasis, separation) arrays
+    '''
     rcParams['xtick.labelsize'] = fs
     rcParams['ytick.labelsize'] = fs
     rcParams['axes.labelsize'] = fs
     rcParams['legend.fontsize'] = fs
     rcParams['font.family'] = 'serif'
     rc('text', usetex=True)
-    bind_neg_y, bind_neg_x, bind_pos_y, bind_pos_x, bind_y, bind_x = pairPropEpSplitter(bindDevData, bindSepData)
-    fold_neg_y, fold_neg_x, fold_pos_y, fold_pos_x, fold_y, fold_x = pairPropEpSplitter(foldDevData, foldSepData)
+    bind_neg_y, bind_neg_x, bind_pos_y, bind_pos_x, bind_y, bind_x = pairPropEpSplitter(*bind)
+    fold_neg_y, fold_neg_x, fold_pos_y, fold_pos_x, fold_y, fold_x = pairPropEpSplitter(*fold)
+    ymax = max([bind[0].max(), fold[0].max()])
     fig, (ax1, ax2) = plt.subplots(2,1,sharex=True, figsize=(11,9))
     ax1.scatter(bind_x, bind_y, edgecolor='k', facecolor='None', label = 'No epistasis')
     ax1.plot(np.linspace(0,40,40), np.zeros(40), color='k')
@@ -59,10 +65,14 @@ def plotter1(fs, outfile):
     fig.tight_layout()
     fig.savefig(outfile + '.pdf')
 
-def plotter2(fs, outfile):
+def plotter2(bind, z, fs, outfile, nticks=9):
+    '''
+    Binding epistasis against separation coloured by z, bind given as (epistasis, separation)
+    arrays, with nticks ticks on the epistasis axis
+    '''
     plt.rcParams.update({'font.size' : fs})
     fig, ax = plt.subplots(1,1, figsize=(9,7))
-    ax.scatter(bindSepData, bindDevData, c=bindZ, edgecolor='', facecolor='None')
+    ax.scatter(bind[1], bind[0], c=z, edgecolor='', facecolor='None')
     ax.set_xlabel(r'$C_{\alpha}$ Separation (\AA)')
     ax.set_ylabel(r'$\epsilon$ (kcal$\cdot$mol$^{-1}$)')
     ax.set_yticks(np.round(np.linspace(-6, 5, nticks),2))
@@ -93,18 +103,7 @@ if __name__ == '__main__':
         sys.exit(1)
     args = parser.parse_args()
 
-    bindData = pd.read_csv(args.bind, sep='\t')
-    foldData = pd.read_csv(args.fold, sep='\t')
-
-    bindDevData = bindData['epistasis']
-    bindSepData = bindData['separation']
-    foldDevData = foldData['epistasis']
-    foldSepData = foldData['separation']
-
-
-    ymax = max([bindDevData.max(), foldDevData.max()])
-    ymin = min([bindDevData.min(), foldDevData.min()])
-
-    nticks = 9
+    bindDevData, bindSepData = loadcolumns(args.bind, ['epistasis', 'separation'])
+    foldDevData, foldSepData = loadcolumns(args.fold, ['epistasis', 'separation'])
 
-    plotter1(args.fs, args.outfile)
+    plotter1((bindDevData, bindSepData), (foldDevData, foldSepData), args.fs, args.outfile)